@@ -1,11 +1,15 @@
 from .abstract_token_bucket_carousel import TokenBucketCarousel
+from .compact_redis_token_bucket_carousel import CompactRedisTokenBucketCarousel
 from .dynamodb_token_bucket_carousel import DynamoDBTokenBucketCarousel
+from .hybrid_token_bucket_carousel import HybridTokenBucketCarousel
 from .inmemory_token_bucket_carousel import InMemoryTokenBucketCarousel
 from .redis_token_bucket_carousel import RedisTokenBucketCarousel
 
 __all__ = [
     "TokenBucketCarousel",
+    "CompactRedisTokenBucketCarousel",
     "DynamoDBTokenBucketCarousel",
+    "HybridTokenBucketCarousel",
     "InMemoryTokenBucketCarousel",
     "RedisTokenBucketCarousel",
 ]
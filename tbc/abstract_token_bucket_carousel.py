@@ -1,20 +1,242 @@
+import asyncio
 import time
 from abc import ABC, abstractmethod
-from typing import NewType
+from itertools import islice
+from typing import Callable, Iterable, Iterator, NewType, Optional
+
+from tbc.errors import (
+    InsufficientTokensError,
+    InvalidModelError,
+    InvalidRegionError,
+    InvalidTenantError,
+)
 
 Model = NewType("Model", str)
 Region = NewType("Region", str)
+Tenant = NewType("Tenant", str)
+
+# (model, region, tenant, state) where tenant is None for a model region bucket
+# and state is what read_model_region / read_tenant_quota return
+BucketRecord = tuple[Model, Region, Optional[Tenant], dict]
+BucketKey = tuple[Model, Region, Optional[Tenant]]
+
+MICROSECONDS = 1_000_000
+
+
+def gcra_tokens_remaining(
+    token_allowance: int,
+    token_refresh_seconds: int,
+    theoretical_arrival_time_us: int,
+    now_us: int,
+) -> int:
+    """Number of tokens a GCRA bucket could grant right now"""
+    period = token_refresh_seconds * MICROSECONDS
+    if token_allowance <= 0 or period <= 0:
+        return 0
+    debt = max(theoretical_arrival_time_us, now_us) - now_us
+    return max(0, min(token_allowance, (period - debt) * token_allowance // period))
+
+
+def gcra_take(
+    token_allowance: int,
+    token_refresh_seconds: int,
+    theoretical_arrival_time_us: int,
+    required_tokens: int,
+    now_us: int,
+) -> tuple[Optional[int], Optional[float]]:
+    """Check a request against a GCRA bucket
+
+    Returns:
+        tuple[Optional[int], Optional[float]]: The new theoretical arrival
+            time and None if granted, otherwise None and the seconds until the
+            request would conform (None if it never can)
+    """
+    period = token_refresh_seconds * MICROSECONDS
+    if required_tokens > token_allowance:
+        return None, None
+    tat = max(theoretical_arrival_time_us, now_us)
+    new_tat = tat + required_tokens * period // token_allowance
+    if new_tat - period > now_us:
+        return None, (new_tat - period - now_us) / MICROSECONDS
+    return new_tat, None
+
+
+def gcra_consume(
+    token_allowance: int,
+    token_refresh_seconds: int,
+    theoretical_arrival_time_us: int,
+    tokens: int,
+    now_us: int,
+) -> int:
+    """Theoretical arrival time after unconditionally taking tokens
+
+    The result is capped at an empty bucket, like a token count at zero.
+    """
+    period = token_refresh_seconds * MICROSECONDS
+    tat = max(theoretical_arrival_time_us, now_us)
+    if token_allowance > 0:
+        tat += tokens * period // token_allowance
+    return min(tat, now_us + period)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Split an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 
 class TokenBucketCarousel(ABC):
-    """Abstract base class for a token bucket carousel"""
+    """Abstract base class for a token bucket carousel
+
+    With gcra set, each bucket is limited with the generic cell rate algorithm:
+    its whole state is one theoretical arrival time (in microseconds) instead
+    of a remaining token count and last refresh time. The rate and burst are
+    still derived from token_allowance and token_refresh_seconds, and
+    tokens_remaining is reported as the burst currently available.
+
+    The regions of each model are listed once and cached for
+    region_cache_seconds, or until a take finds a cached region deleted.
 
-    def __init__(self):
+    request_tokens remembers regions that turned a request down until they
+    next refresh, and skips them for requests at least as large. Regions
+    whose backend calls keep failing (or, with slow_take_seconds set, keep
+    being slow) are skipped for circuit_breaker_cooldown_seconds.
+
+    With coalesce_window_seconds set, concurrent requests for the same bucket
+    are collected for that long (or until coalesce_max_batch_size of them are
+    waiting) and taken together in one atomic backend call.
+    """
+
+    # Consecutive failed or slow takes after which a region is skipped
+    circuit_breaker_failures = 3
+    # Seconds a region is skipped for once its circuit breaker opens
+    circuit_breaker_cooldown_seconds = 5.0
+    # Takes slower than this count as failures, None to only count errors
+    slow_take_seconds = None
+    # Seconds concurrent requests for a bucket are collected for before being
+    # taken in one backend call, None to take each request on its own
+    coalesce_window_seconds = None
+    # Number of collected requests that triggers the backend call early
+    coalesce_max_batch_size = 64
+    # Seconds the regions of a model are cached for, None to keep them until
+    # a take finds one deleted
+    region_cache_seconds = 60.0
+
+    def __init__(self, gcra: bool = False):
         self._models = {}
+        self._regions_listed_at = {}
+        self._batches = {}
+        self.gcra = gcra
 
     def _current_time(self):
         return int(time.time())
 
+    def _current_time_us(self):
+        return int(time.time() * MICROSECONDS)
+
+    def _clock(self) -> float:
+        """Current time in seconds on the clock buckets are refreshed by"""
+        if self.gcra:
+            return self._current_time_us() / MICROSECONDS
+        return self._current_time()
+
+    def _new_state(self, token_allowance: int) -> dict:
+        if self.gcra:
+            return {"theoretical_arrival_time_us": self._current_time_us()}
+        return {
+            "tokens_remaining": token_allowance,
+            "last_refresh": self._current_time(),
+        }
+
+    def _public_state(self, state: dict) -> dict:
+        """Add the derived remaining tokens to a stored GCRA bucket state"""
+        if not self.gcra:
+            return state
+        return {
+            **state,
+            "tokens_remaining": gcra_tokens_remaining(
+                state["token_allowance"],
+                state["token_refresh_seconds"],
+                state["theoretical_arrival_time_us"],
+                self._current_time_us(),
+            ),
+        }
+
+    def _grant_tokens(
+        self, buckets: list[dict], required_tokens: list[int]
+    ) -> list[tuple[bool, Optional[float]]]:
+        """Grant requests in order against nested buckets, updating them in place
+
+        Each request is granted only if every bucket can cover it. Buckets
+        whose refresh period has elapsed are refilled first.
+
+        Returns:
+            list[tuple[bool, Optional[float]]]: Per request, whether it was
+                granted and otherwise the seconds until it could be, or None
+                if it exceeds a bucket's allowance
+        """
+        results = []
+        if self.gcra:
+            now = self._current_time_us()
+            for tokens in required_tokens:
+                arrival_times = []
+                for bucket in buckets:
+                    arrival_time, retry_after = gcra_take(
+                        bucket["token_allowance"],
+                        bucket["token_refresh_seconds"],
+                        bucket["theoretical_arrival_time_us"],
+                        tokens,
+                        now,
+                    )
+                    if arrival_time is None:
+                        results.append((False, retry_after))
+                        break
+                    arrival_times.append(arrival_time)
+                else:
+                    for bucket, arrival_time in zip(buckets, arrival_times):
+                        bucket["theoretical_arrival_time_us"] = arrival_time
+                    results.append((True, None))
+            return results
+
+        now = self._current_time()
+        for bucket in buckets:
+            if now >= bucket["last_refresh"] + bucket["token_refresh_seconds"]:
+                bucket["tokens_remaining"] = bucket["token_allowance"]
+                bucket["last_refresh"] = now
+        for tokens in required_tokens:
+            for bucket in buckets:
+                if tokens > bucket["token_allowance"]:
+                    results.append((False, None))
+                    break
+                if bucket["tokens_remaining"] < tokens:
+                    refresh = bucket["last_refresh"] + bucket["token_refresh_seconds"]
+                    results.append((False, refresh - now))
+                    break
+            else:
+                for bucket in buckets:
+                    bucket["tokens_remaining"] -= tokens
+                results.append((True, None))
+        return results
+
+    def _stored_state(self, state: dict) -> dict:
+        """Convert an imported bucket state to this carousel's algorithm"""
+        state = dict(state)
+        if self.gcra and "theoretical_arrival_time_us" not in state:
+            period = state["token_refresh_seconds"] * MICROSECONDS
+            debt = state["token_allowance"] - state["tokens_remaining"]
+            state["theoretical_arrival_time_us"] = self._current_time_us() + (
+                debt * period // max(state["token_allowance"], 1)
+            )
+        elif not self.gcra and "last_refresh" not in state:
+            state["last_refresh"] = self._current_time()
+        if self.gcra:
+            state.pop("tokens_remaining", None)
+            state.pop("last_refresh", None)
+        else:
+            state.pop("theoretical_arrival_time_us", None)
+        return state
+
     @abstractmethod
     def list_models(self) -> set[Model]:
         """List all models in the carousel
@@ -123,6 +345,207 @@ class TokenBucketCarousel(ABC):
         raise NotImplementedError
 
     @abstractmethod
+    def create_tenant_quota(
+        self,
+        model: Model,
+        region: Region,
+        tenant: Tenant,
+        token_allowance: int,
+        token_refresh_seconds: int,
+    ):
+        """Create a tenant quota nested inside a model region
+
+        Tokens requested on behalf of the tenant are taken from both the
+        tenant quota and the model region bucket, atomically.
+
+        Args:
+            model (Model): The model of the parent region
+            region (Region): The parent region
+            tenant (Tenant): The tenant to create a quota for
+            token_allowance (int): Number of tokens in the tenant bucket
+            token_refresh_seconds (int): Time in seconds to refresh tokens
+
+        Raises:
+            NotImplementedError: _description_
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        """Read the current state of a tenant quota
+
+        Args:
+            model (Model): The model of the parent region
+            region (Region): The parent region
+            tenant (Tenant): The tenant to read
+
+        Raises:
+            NotImplementedError: _description_
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        """Delete a tenant quota
+
+        Args:
+            model (Model): The model of the parent region
+            region (Region): The parent region
+            tenant (Tenant): The tenant to delete
+
+        Raises:
+            NotImplementedError: _description_
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def export_buckets(self, batch_size: int = 1000) -> Iterator[BucketRecord]:
+        """Stream the state of every bucket and tenant quota in the carousel
+
+        Args:
+            batch_size (int): Number of buckets fetched from the backend at once
+
+        Raises:
+            NotImplementedError: _description_
+
+        Returns:
+            Iterator[BucketRecord]: The buckets, tenant quotas included
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def import_buckets(
+        self, buckets: Iterable[BucketRecord], batch_size: int = 1000
+    ) -> int:
+        """Write buckets as exported by export_buckets, overwriting existing ones
+
+        Unlike create_model_region, the remaining tokens and last refresh time
+        are restored as given.
+
+        Args:
+            buckets (Iterable[BucketRecord]): The buckets to write
+            batch_size (int): Number of buckets written to the backend at once
+
+        Raises:
+            NotImplementedError: _description_
+
+        Returns:
+            int: Number of buckets written
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def consume_tokens(self, deltas: dict[BucketKey, int]) -> dict[BucketKey, dict]:
+        """Take tokens from many buckets at once without checking availability
+
+        Settles consumption that was already granted elsewhere, such as by a
+        local mirror. Buckets due a refresh are refilled first and none is
+        taken below empty. A delta of 0 just reads the bucket.
+
+        Args:
+            deltas (dict[BucketKey, int]): Tokens to take per bucket, keyed by
+                (model, region, tenant) with tenant None for a region bucket
+
+        Raises:
+            NotImplementedError: _description_
+            PartialConsumptionError: If the backend failed after settling some
+                of the deltas, which are listed in settled
+
+        Returns:
+            dict[BucketKey, dict]: The new state of every bucket that exists,
+                without meta
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def _take_tokens_batch(
+        self,
+        model: Model,
+        region: Region,
+        required_tokens: list[int],
+        tenant: Optional[Tenant] = None,
+    ) -> list[tuple[Optional[dict], Optional[float]]]:
+        """Atomically take tokens for several requests from one region
+
+        The requests are granted in order, each from the region and, if given,
+        a tenant quota. Buckets whose refresh period has elapsed are refilled
+        before the check. Either every level is decremented for a request or
+        none is.
+
+        Args:
+            model (Model): The model to take tokens from
+            region (Region): The region to take tokens from
+            required_tokens (list[int]): Number of tokens required per request
+            tenant (Tenant): Tenant quota to take tokens from as well
+
+        Raises:
+            NotImplementedError: _description_
+
+        Returns:
+            list[tuple[Optional[dict], Optional[float]]]: Per request, the
+                region meta and None if granted, otherwise None and the seconds
+                until the request could be granted (None if it never can, e.g.
+                the tenant has no quota in the region)
+        """
+        raise NotImplementedError
+
+    def _take_tokens(
+        self,
+        model: Model,
+        region: Region,
+        required_tokens: int,
+        tenant: Optional[Tenant] = None,
+    ) -> tuple[Optional[dict], Optional[float]]:
+        """Atomically take tokens from a region and, if given, a tenant quota"""
+        return self._take_tokens_batch(model, region, [required_tokens], tenant)[0]
+
+    async def _take_tokens_coalesced(
+        self,
+        model: Model,
+        region: Region,
+        required_tokens: int,
+        tenant: Optional[Tenant] = None,
+    ) -> tuple[Optional[dict], Optional[float]]:
+        key = (model, region, tenant)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = []
+            loop.call_later(self.coalesce_window_seconds, self._flush_batch, key, batch)
+        batch.append((required_tokens, future))
+        if len(batch) >= self.coalesce_max_batch_size:
+            self._flush_batch(key, batch)
+        return await future
+
+    def _flush_batch(self, key: BucketKey, batch: list):
+        if self._batches.get(key) is not batch:
+            return
+        del self._batches[key]
+        # Cancelled requests must not take tokens
+        batch = [(tokens, future) for tokens, future in batch if not future.done()]
+        if not batch:
+            return
+        model, region, tenant = key
+        try:
+            results = self._recorded_take(
+                [self._models.get(model, {}).get(region, {})],
+                self._take_tokens_batch,
+                model,
+                region,
+                [tokens for tokens, _ in batch],
+                tenant,
+            )
+        except Exception as err:
+            results = [err] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
     async def request_tokens(
         self,
         model: Model,
@@ -130,6 +553,7 @@ class TokenBucketCarousel(ABC):
         fallback_models: set[Model] = None,
         allowed_regions: set[Region] = None,
         preferred_region: Region = None,
+        tenant: Tenant = None,
     ) -> dict:
         """Request tokens from the carousel
 
@@ -139,14 +563,209 @@ class TokenBucketCarousel(ABC):
             fallback_models (set[Model]): Models to fallback to if the requested model does not have enough tokens
             allowed_regions (set[Region]): Regions to request tokens from
             preferred_region (Region): Preferred region to request tokens from
+            tenant (Tenant): Tenant whose quota is charged alongside the region
 
         Raises:
-            NotImplementedError: _description_
+            InsufficientTokensError: No allowed region has enough tokens, with
+                the soonest time any of them could grant the request
+
+        Returns:
+            dict: The meta of the region the tokens were taken from
         """
-        raise NotImplementedError
+        retry_after = None
+        error = None
+        now = self._clock()
+        for candidate in [model, *(fallback_models or ())]:
+            regions = self._candidate_regions(
+                candidate, allowed_regions, preferred_region
+            )
+            # Kept even if a take forgets the cached regions
+            region_states = self._models[candidate]
+            to_try = {}
+            for region in regions:
+                wait = self._skip_seconds(
+                    region_states[region], required_tokens, tenant, now
+                )
+                if wait is None:
+                    to_try[region] = region_states[region]
+                elif retry_after is None or wait < retry_after:
+                    retry_after = wait
+            if not to_try:
+                continue
+
+            meta, waits, take_error = await self._take_first_region(
+                candidate, to_try, required_tokens, tenant
+            )
+            if take_error is not None:
+                error = take_error
+            for region, wait in waits.items():
+                self._record_exhausted(
+                    region_states[region], required_tokens, tenant, now, now + wait
+                )
+                if retry_after is None or wait < retry_after:
+                    retry_after = wait
+            if meta is not None:
+                return meta
+        if error is not None:
+            raise error
+        raise InsufficientTokensError(
+            f"Model {model} does not have {required_tokens} tokens available",
+            retry_after=retry_after,
+        )
+
+    async def _take_first_region(
+        self,
+        model: Model,
+        region_states: dict[Region, dict],
+        required_tokens: int,
+        tenant: Optional[Tenant],
+    ) -> tuple[Optional[dict], dict[Region, float], Optional[Exception]]:
+        """Take tokens from the first of a model's regions able to grant them
+
+        Regions are tried one backend call at a time, in order. Backends that
+        can try several regions in one call override this.
+
+        Args:
+            model (Model): The model to take tokens from
+            region_states (dict[Region, dict]): The regions to try, in order,
+                with their skip and circuit breaker state
+            required_tokens (int): Number of tokens required
+            tenant (Tenant): Tenant whose quota is charged alongside the region
+
+        Returns:
+            tuple[Optional[dict], dict[Region, float], Optional[Exception]]: The
+                meta of the region the tokens were taken from, or None, the
+                seconds until each region that turned the request down could
+                grant it, and the last backend error
+        """
+        waits = {}
+        error = None
+        for region, region_state in region_states.items():
+            try:
+                if self.coalesce_window_seconds is None:
+                    meta, wait = self._recorded_take(
+                        [region_state],
+                        self._take_tokens,
+                        model,
+                        region,
+                        required_tokens,
+                        tenant,
+                    )
+                else:
+                    meta, wait = await self._take_tokens_coalesced(
+                        model, region, required_tokens, tenant
+                    )
+            except InvalidRegionError:
+                # Deleted by another client since the regions were listed
+                self._forget_regions(model)
+                continue
+            except (InvalidModelError, InvalidTenantError):
+                raise
+            except Exception as err:
+                error = err
+                continue
+            if meta is not None:
+                return meta, waits, error
+            if wait is not None:
+                waits[region] = wait
+        return None, waits, error
+
+    def _skip_seconds(
+        self,
+        region_state: dict,
+        required_tokens: int,
+        tenant: Optional[Tenant],
+        now: float,
+    ) -> Optional[float]:
+        """Seconds until a region is worth trying again, None to try it now"""
+        waits = []
+        if region_state.get("open_until", now) > now:
+            waits.append(region_state["open_until"] - now)
+        for level in {None, tenant}:
+            until, smallest_denied = region_state.get("exhausted", {}).get(
+                level, (now, 0)
+            )
+            if until > now and required_tokens >= smallest_denied:
+                waits.append(until - now)
+        return max(waits, default=None)
+
+    def _record_exhausted(
+        self,
+        region_state: dict,
+        required_tokens: int,
+        tenant: Optional[Tenant],
+        now: float,
+        until: float,
+    ):
+        exhausted = region_state.setdefault("exhausted", {})
+        previous_until, smallest_denied = exhausted.get(tenant, (now, 0))
+        if previous_until > now:
+            required_tokens = min(required_tokens, smallest_denied)
+        exhausted[tenant] = (until, required_tokens)
+
+    def _recorded_take(self, region_states: list[dict], take: Callable, *args):
+        """Call a backend take, feeding the outcome to the circuit breakers of
+        the regions it covers"""
+        now = self._clock()
+        started = time.perf_counter()
+        try:
+            result = take(*args)
+        except (InvalidModelError, InvalidRegionError, InvalidTenantError):
+            raise
+        except Exception:
+            for region_state in region_states:
+                self._record_failure(region_state, now)
+            raise
+        elapsed = time.perf_counter() - started
+        for region_state in region_states:
+            self._record_take(region_state, elapsed, now)
+        return result
+
+    def _record_take(self, region_state: dict, elapsed: float, now: float):
+        if self.slow_take_seconds is not None and elapsed > self.slow_take_seconds:
+            self._record_failure(region_state, now)
+        else:
+            region_state["failures"] = 0
+
+    def _record_failure(self, region_state: dict, now: float):
+        region_state["failures"] = region_state.get("failures", 0) + 1
+        if region_state["failures"] >= self.circuit_breaker_failures:
+            region_state["open_until"] = now + self.circuit_breaker_cooldown_seconds
+
+    def _candidate_regions(
+        self,
+        model: Model,
+        allowed_regions: set[Region] = None,
+        preferred_region: Region = None,
+    ) -> list[Region]:
+        regions = self._get_regions(model)
+        if allowed_regions:
+            regions &= allowed_regions
+        candidates = sorted(regions)
+        if preferred_region in regions:
+            candidates.remove(preferred_region)
+            candidates.insert(0, preferred_region)
+        return candidates
 
     def _get_regions(self, model: Model):
-        if model not in self._models:
+        now = time.monotonic()
+        if model not in self._models or (
+            self.region_cache_seconds is not None
+            and now - self._regions_listed_at[model] >= self.region_cache_seconds
+        ):
             regions = self.list_model_regions(model)
-            self._models[model] = {region: {} for region in regions}
+            # Regions still listed keep their skip and circuit breaker state
+            region_states = self._models.get(model, {})
+            self._models[model] = {
+                region: region_states.get(region, {}) for region in regions
+            }
+            self._regions_listed_at[model] = now
         return set(self._models[model].keys())
+
+    def _forget_regions(self, model: Model):
+        self._models.pop(model, None)
+        self._regions_listed_at.pop(model, None)
+
+    def _reset_region(self, model: Model, region: Region):
+        if region in self._models.get(model, {}):
+            self._models[model][region] = {}
@@ -0,0 +1,844 @@
+import json
+from typing import Iterable, Iterator, Optional
+
+from redis import Redis
+from redis.exceptions import ResponseError
+
+from tbc.abstract_token_bucket_carousel import (
+    MICROSECONDS,
+    BucketKey,
+    BucketRecord,
+    Model,
+    Region,
+    Tenant,
+    TokenBucketCarousel,
+    batched,
+)
+from tbc.errors import (
+    InvalidModelError,
+    InvalidRegionError,
+    InvalidTenantError,
+    PartialConsumptionError,
+)
+
+# Tenant quotas share the model counters hash under "<region>#<tenant>"
+TENANT_SEPARATOR = "#"
+# Config hash field counting meta writes, kept when the last region goes so a
+# recreated region never reuses a version cached by some client
+VERSION_FIELD = "#version"
+
+# A counter is the colon separated integers allowance:refresh_seconds:version
+# followed by remaining:last_refresh, or by the theoretical arrival time in
+# microseconds in GCRA mode. Tenant counters have version 0.
+COUNTER_LUA_FUNCTIONS = """
+local function decode(counter)
+    local level = {}
+    for value in string.gmatch(counter, '[^:]+') do
+        level[#level + 1] = tonumber(value)
+    end
+    return level
+end
+
+local function encode(level)
+    local values = {}
+    for i, value in ipairs(level) do
+        values[i] = string.format('%d', value)
+    end
+    return table.concat(values, ':')
+end
+"""
+
+# KEYS are the counters and config hashes, ARGV whether to refuse existing
+# counters, the counter field, its parent region field (or ''), the meta JSON
+# (or '' for tenants), the version field and the counter values bar the version.
+PUT_LUA_SCRIPT = """
+local field, parent, meta = ARGV[2], ARGV[3], ARGV[4]
+if ARGV[1] == '1' then
+    if parent ~= '' and redis.call('HEXISTS', KEYS[1], parent) == 0 then
+        return redis.error_reply('Parent field does not exist')
+    end
+    if redis.call('HEXISTS', KEYS[1], field) == 1 then
+        return redis.error_reply('Field already exists')
+    end
+end
+local version = 0
+if meta ~= '' then
+    version = redis.call('HINCRBY', KEYS[2], ARGV[5], 1)
+    redis.call('HSET', KEYS[2], field, meta)
+end
+local counter = {ARGV[6], ARGV[7], version}
+for i = 8, #ARGV do
+    counter[#counter + 1] = ARGV[i]
+end
+redis.call('HSET', KEYS[1], field, table.concat(counter, ':'))
+return redis.status_reply('OK')
+"""
+
+# KEYS are the counters and config hashes, ARGV the region field, its new
+# allowance, refresh seconds and meta JSON, and the version field.
+UPDATE_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local counter = redis.call('HGET', KEYS[1], ARGV[1])
+if not counter then
+    return redis.error_reply('Field does not exist')
+end
+local level = decode(counter)
+level[1] = tonumber(ARGV[2])
+level[2] = tonumber(ARGV[3])
+level[3] = redis.call('HINCRBY', KEYS[2], ARGV[5], 1)
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[4])
+redis.call('HSET', KEYS[1], ARGV[1], encode(level))
+return redis.status_reply('OK')
+"""
+)
+
+# Removes the region along with its meta and tenant quotas. ARGV is the region
+# field and the prefix of its tenant quota fields.
+DELETE_LUA_SCRIPT = """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return redis.error_reply('Field does not exist')
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+local prefix = ARGV[2]
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if string.sub(field, 1, #prefix) == prefix then
+        redis.call('HDEL', KEYS[1], field)
+    end
+end
+return redis.status_reply('OK')
+"""
+
+REPLENISH_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local counter = redis.call('HGET', KEYS[1], ARGV[1])
+if not counter then
+    return redis.error_reply('Field does not exist')
+end
+local level = decode(counter)
+if #level == 4 then
+    level[4] = tonumber(ARGV[2])
+else
+    level[4] = level[1]
+    level[5] = tonumber(ARGV[2])
+end
+redis.call('HSET', KEYS[1], ARGV[1], encode(level))
+return redis.status_reply('OK')
+"""
+)
+
+# KEYS is the counters hash, ARGV the current time, the region field, the
+# tenant field (or '') and the tokens required per request. Returns the
+# region meta version followed by {1} per granted request or {0, seconds
+# until it could be granted}, as the TAKE_LUA_SCRIPT of the per-region layout.
+TAKE_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local now = tonumber(ARGV[1])
+local fields = {ARGV[2]}
+if ARGV[3] ~= '' then
+    fields[2] = ARGV[3]
+end
+local counters = redis.call('HMGET', KEYS[1], unpack(fields))
+local levels = {}
+for i = 1, #fields do
+    if not counters[i] then
+        if i == 1 then
+            return redis.error_reply('Field does not exist')
+        end
+        return {false}
+    end
+    local level = decode(counters[i])
+    if now >= level[5] + level[2] then
+        level[4] = level[1]
+        level[5] = now
+    end
+    levels[i] = level
+end
+local results = {levels[1][3]}
+for j = 4, #ARGV do
+    local required = tonumber(ARGV[j])
+    local result = {1}
+    for _, level in ipairs(levels) do
+        if required > level[1] then
+            result = {0, -1}
+            break
+        elseif level[4] < required then
+            result = {0, level[5] + level[2] - now}
+            break
+        end
+    end
+    if result[1] == 1 then
+        for _, level in ipairs(levels) do
+            level[4] = level[4] - required
+        end
+    end
+    results[#results + 1] = result
+end
+for i, field in ipairs(fields) do
+    redis.call('HSET', KEYS[1], field, encode(levels[i]))
+end
+return results
+"""
+)
+
+GCRA_TAKE_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local now = tonumber(ARGV[1])
+local fields = {ARGV[2]}
+if ARGV[3] ~= '' then
+    fields[2] = ARGV[3]
+end
+local counters = redis.call('HMGET', KEYS[1], unpack(fields))
+local levels = {}
+for i = 1, #fields do
+    if not counters[i] then
+        if i == 1 then
+            return redis.error_reply('Field does not exist')
+        end
+        return {false}
+    end
+    levels[i] = decode(counters[i])
+end
+local results = {levels[1][3]}
+for j = 4, #ARGV do
+    local required = tonumber(ARGV[j])
+    local result = {1}
+    local arrival_times = {}
+    for i, level in ipairs(levels) do
+        local period = level[2] * 1000000
+        if required > level[1] then
+            result = {0, '-1'}
+            break
+        end
+        arrival_times[i] = math.max(level[4], now) + math.floor(required * period / level[1])
+        if arrival_times[i] - period > now then
+            result = {0, string.format('%d', arrival_times[i] - period - now)}
+            break
+        end
+    end
+    if result[1] == 1 then
+        for i, level in ipairs(levels) do
+            level[4] = arrival_times[i]
+        end
+    end
+    results[#results + 1] = result
+end
+for i, field in ipairs(fields) do
+    redis.call('HSET', KEYS[1], field, encode(levels[i]))
+end
+return results
+"""
+)
+
+# KEYS is the counters hash, ARGV the current time, the tokens required, the
+# suffix of the tenant quota fields (or '') and the candidate region fields in
+# order. Takes from the first
+# region (and its tenant quota) able to grant the request. Returns its 1-based
+# position, or 0, and its meta version, followed by the seconds until each
+# region tried before it could grant the request, with -1 meaning never and -2
+# that the region no longer exists.
+TAKE_FIRST_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local now, required, tenant_suffix = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+local results = {0, false}
+for i = 4, #ARGV do
+    local fields = {ARGV[i]}
+    if tenant_suffix ~= '' then
+        fields[2] = ARGV[i] .. tenant_suffix
+    end
+    local counters = redis.call('HMGET', KEYS[1], unpack(fields))
+    local wait
+    local levels = {}
+    if not counters[1] then
+        wait = -2
+    elseif not counters[#fields] then
+        wait = -1
+    end
+    for j = 1, #fields do
+        if wait then
+            break
+        end
+        local level = decode(counters[j])
+        if now >= level[5] + level[2] then
+            level[4] = level[1]
+            level[5] = now
+        end
+        if required > level[1] then
+            wait = -1
+        elseif level[4] < required then
+            wait = level[5] + level[2] - now
+        end
+        levels[j] = level
+    end
+    if not wait then
+        for j, field in ipairs(fields) do
+            levels[j][4] = levels[j][4] - required
+            redis.call('HSET', KEYS[1], field, encode(levels[j]))
+        end
+        results[1] = i - 3
+        results[2] = levels[1][3]
+        return results
+    end
+    results[#results + 1] = string.format('%d', wait)
+end
+return results
+"""
+)
+
+GCRA_TAKE_FIRST_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local now, required, tenant_suffix = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+local results = {0, false}
+for i = 4, #ARGV do
+    local fields = {ARGV[i]}
+    if tenant_suffix ~= '' then
+        fields[2] = ARGV[i] .. tenant_suffix
+    end
+    local counters = redis.call('HMGET', KEYS[1], unpack(fields))
+    local wait
+    local levels = {}
+    if not counters[1] then
+        wait = -2
+    elseif not counters[#fields] then
+        wait = -1
+    end
+    for j = 1, #fields do
+        if wait then
+            break
+        end
+        local level = decode(counters[j])
+        local period = level[2] * 1000000
+        if required > level[1] then
+            wait = -1
+        else
+            local arrival_time = math.max(level[4], now) + math.floor(required * period / level[1])
+            if arrival_time - period > now then
+                wait = arrival_time - period - now
+            end
+            level[4] = arrival_time
+        end
+        levels[j] = level
+    end
+    if not wait then
+        for j, field in ipairs(fields) do
+            redis.call('HSET', KEYS[1], field, encode(levels[j]))
+        end
+        results[1] = i - 3
+        results[2] = levels[1][3]
+        return results
+    end
+    results[#results + 1] = string.format('%d', wait)
+end
+return results
+"""
+)
+
+# KEYS is the counters hash, ARGV the current time followed by pairs of field
+# and delta. Missing fields are returned as nil, the others as their updated
+# counter.
+CONSUME_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local now = tonumber(ARGV[1])
+local counters = {}
+for i = 2, #ARGV, 2 do
+    local counter = redis.call('HGET', KEYS[1], ARGV[i])
+    if counter then
+        local level = decode(counter)
+        if now >= level[5] + level[2] then
+            level[4] = level[1]
+            level[5] = now
+        end
+        level[4] = math.max(level[4] - tonumber(ARGV[i + 1]), 0)
+        counter = encode(level)
+        redis.call('HSET', KEYS[1], ARGV[i], counter)
+    end
+    counters[#counters + 1] = counter
+end
+return counters
+"""
+)
+
+GCRA_CONSUME_LUA_SCRIPT = (
+    COUNTER_LUA_FUNCTIONS
+    + """
+local now = tonumber(ARGV[1])
+local counters = {}
+for i = 2, #ARGV, 2 do
+    local counter = redis.call('HGET', KEYS[1], ARGV[i])
+    if counter then
+        local level = decode(counter)
+        local period = level[2] * 1000000
+        local arrival_time = math.max(level[4], now)
+        if level[1] > 0 then
+            arrival_time = arrival_time + math.floor(tonumber(ARGV[i + 1]) * period / level[1])
+        end
+        level[4] = math.min(arrival_time, now + period)
+        counter = encode(level)
+        redis.call('HSET', KEYS[1], ARGV[i], counter)
+    end
+    counters[#counters + 1] = counter
+end
+return counters
+"""
+)
+
+
+class CompactRedisTokenBucketCarousel(TokenBucketCarousel):
+    """Stores each model as two Redis hashes instead of a hash per bucket
+
+    The counters hash holds one small field per region and tenant quota,
+    packing the allowance, refresh period, meta version and remaining tokens
+    into a colon separated string, so one script sees every bucket of a
+    model: request_tokens tries all candidate regions of a model in a single
+    call, taking from the first able to grant the request. Region meta lives
+    in a separate config hash which the request path never reads: takes
+    return the meta version, and the decoded meta is cached client-side until
+    the version changes. With coalesce_window_seconds set, requests are
+    batched per region as in the other backends.
+
+    Both hashes share the "{model}" hash tag so the scripts touching them
+    stay within one Redis Cluster slot.
+    """
+
+    def __init__(
+        self, redis_client: Redis, namespace: str = "tbc.compact", gcra: bool = False
+    ):
+        super().__init__(gcra=gcra)
+        self.redis_client = redis_client
+        self.namespace = namespace
+        # (model, region) -> (version, meta)
+        self.__meta = {}
+
+    def _counters_key(self, model: Model) -> str:
+        return f"{self.namespace}:{{{model}}}:counters"
+
+    def _config_key(self, model: Model) -> str:
+        return f"{self.namespace}:{{{model}}}:config"
+
+    def _field(self, region: Region, tenant: Optional[Tenant] = None) -> str:
+        if tenant is None:
+            return region
+        return f"{region}{TENANT_SEPARATOR}{tenant}"
+
+    def _state(self, counter: str) -> dict:
+        allowance, refresh_seconds, _, *counts = map(int, counter.split(":"))
+        state = {
+            "token_allowance": allowance,
+            "token_refresh_seconds": refresh_seconds,
+        }
+        if len(counts) == 1:
+            state["theoretical_arrival_time_us"] = counts[0]
+        else:
+            state["tokens_remaining"], state["last_refresh"] = counts
+        return state
+
+    def _counts(self, state: dict) -> list[int]:
+        counts = [state["token_allowance"], state["token_refresh_seconds"]]
+        if self.gcra:
+            counts.append(state["theoretical_arrival_time_us"])
+        else:
+            counts.extend([state["tokens_remaining"], state["last_refresh"]])
+        return counts
+
+    def _decoded_meta(
+        self, model: Model, region: Region, version: int, meta: Optional[str] = None
+    ) -> dict:
+        cached = self.__meta.get((model, region))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if meta is None:
+            meta = self.redis_client.hget(self._config_key(model), region)
+            if meta is None:
+                raise InvalidRegionError(f"Model {model} does not have region {region}")
+        decoded = json.loads(meta)
+        self.__meta[(model, region)] = (version, decoded)
+        return decoded
+
+    async def _take_first_region(
+        self,
+        model: Model,
+        region_states: dict[Region, dict],
+        required_tokens: int,
+        tenant: Optional[Tenant],
+    ) -> tuple[Optional[dict], dict[Region, float], Optional[Exception]]:
+        if self.coalesce_window_seconds is not None:
+            return await super()._take_first_region(
+                model, region_states, required_tokens, tenant
+            )
+        regions = list(region_states)
+        try:
+            meta, waits = self._recorded_take(
+                list(region_states.values()),
+                self._take_first_tokens,
+                model,
+                regions,
+                required_tokens,
+                tenant,
+            )
+        except (InvalidModelError, InvalidRegionError, InvalidTenantError):
+            raise
+        except Exception as err:
+            return None, {}, err
+        return (
+            meta,
+            {region: wait for region, wait in zip(regions, waits) if wait is not None},
+            None,
+        )
+
+    def _take_first_tokens(
+        self,
+        model: Model,
+        regions: list[Region],
+        required_tokens: int,
+        tenant: Optional[Tenant] = None,
+    ) -> tuple[Optional[dict], list[Optional[float]]]:
+        """Take tokens from the first of the regions able to grant them
+
+        Regions deleted since they were listed are passed over, and the
+        model's cached regions forgotten.
+
+        Returns:
+            tuple[Optional[dict], list[Optional[float]]]: The meta of the region
+                the tokens were taken from, or None, and for each region tried
+                before it the seconds until it could grant them
+        """
+        if self.gcra:
+            script, now = GCRA_TAKE_FIRST_LUA_SCRIPT, self._current_time_us()
+        else:
+            script, now = TAKE_FIRST_LUA_SCRIPT, self._current_time()
+        position, version, *waits = self.redis_client.eval(
+            script,
+            1,
+            self._counters_key(model),
+            now,
+            required_tokens,
+            "" if tenant is None else TENANT_SEPARATOR + tenant,
+            *(self._field(region) for region in regions),
+        )
+
+        waits = [int(wait) for wait in waits]
+        if -2 in waits:
+            # Deleted by another client since the regions were listed
+            self._forget_regions(model)
+        waits = [
+            None if wait < 0 else wait / MICROSECONDS if self.gcra else wait
+            for wait in waits
+        ]
+        if not position:
+            return None, waits
+        return self._decoded_meta(model, regions[position - 1], version), waits
+
+    def list_models(self) -> set[Model]:
+        prefix = f"{self.namespace}:{{"
+        keys = self.redis_client.scan_iter(match=self._counters_key("*"))
+        return {key[len(prefix) : -len("}:counters")] for key in keys}
+
+    def list_model_regions(self, model: Model) -> set[Region]:
+        fields = self.redis_client.hkeys(self._counters_key(model))
+        if fields:
+            return {field for field in fields if TENANT_SEPARATOR not in field}
+        raise InvalidModelError(f"Model {model} does not exist")
+
+    def create_model_region(
+        self,
+        model: Model,
+        region: Region,
+        token_allowance: int,
+        token_refresh_seconds: int,
+        meta: dict,
+    ):
+        if TENANT_SEPARATOR in region:
+            raise ValueError(f"Region {region} must not contain {TENANT_SEPARATOR!r}")
+        counts = self._counts(
+            {
+                "token_allowance": token_allowance,
+                "token_refresh_seconds": token_refresh_seconds,
+                **self._new_state(token_allowance),
+            }
+        )
+        try:
+            self.redis_client.eval(
+                PUT_LUA_SCRIPT,
+                2,
+                self._counters_key(model),
+                self._config_key(model),
+                1,
+                self._field(region),
+                "",
+                json.dumps(meta),
+                VERSION_FIELD,
+                *counts,
+            )
+        except ResponseError as err:
+            if "Field already exists" in str(err):
+                raise ValueError(f"Model {model} already has region {region}") from err
+            raise
+        self._forget_regions(model)
+
+    def read_model_region(self, model: Model, region: Region):
+        counter = self.redis_client.hget(self._counters_key(model), region)
+        if counter is None:
+            raise InvalidRegionError(f"Model {model} does not have region {region}")
+        state = self._state(counter)
+        state["meta"] = self._decoded_meta(model, region, int(counter.split(":")[2]))
+        return self._public_state(state)
+
+    def update_model_region(
+        self,
+        model: Model,
+        region: Region,
+        token_allowance: int,
+        token_refresh_seconds: int,
+        meta: dict,
+    ):
+        try:
+            self.redis_client.eval(
+                UPDATE_LUA_SCRIPT,
+                2,
+                self._counters_key(model),
+                self._config_key(model),
+                self._field(region),
+                token_allowance,
+                token_refresh_seconds,
+                json.dumps(meta),
+                VERSION_FIELD,
+            )
+        except ResponseError as err:
+            if "Field does not exist" in str(err):
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            raise
+        self.__meta.pop((model, region), None)
+        self._reset_region(model, region)
+
+    def delete_model_region(self, model: Model, region: Region):
+        try:
+            self.redis_client.eval(
+                DELETE_LUA_SCRIPT,
+                2,
+                self._counters_key(model),
+                self._config_key(model),
+                self._field(region),
+                self._field(region) + TENANT_SEPARATOR,
+            )
+        except ResponseError as err:
+            if "Field does not exist" in str(err):
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            raise
+        self.__meta.pop((model, region), None)
+        self._forget_regions(model)
+
+    def replenish_tokens(self, model: Model, region: Region):
+        now = self._current_time_us() if self.gcra else self._current_time()
+        try:
+            self.redis_client.eval(
+                REPLENISH_LUA_SCRIPT,
+                1,
+                self._counters_key(model),
+                self._field(region),
+                now,
+            )
+        except ResponseError as err:
+            if "Field does not exist" in str(err):
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            raise
+        self._reset_region(model, region)
+
+    def create_tenant_quota(
+        self,
+        model: Model,
+        region: Region,
+        tenant: Tenant,
+        token_allowance: int,
+        token_refresh_seconds: int,
+    ):
+        counts = self._counts(
+            {
+                "token_allowance": token_allowance,
+                "token_refresh_seconds": token_refresh_seconds,
+                **self._new_state(token_allowance),
+            }
+        )
+        try:
+            self.redis_client.eval(
+                PUT_LUA_SCRIPT,
+                2,
+                self._counters_key(model),
+                self._config_key(model),
+                1,
+                self._field(region, tenant),
+                self._field(region),
+                "",
+                VERSION_FIELD,
+                *counts,
+            )
+        except ResponseError as err:
+            if "Parent field does not exist" in str(err):
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            if "Field already exists" in str(err):
+                raise ValueError(
+                    f"Model {model} region {region} already has tenant {tenant}"
+                ) from err
+            raise
+
+    def read_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        counter = self.redis_client.hget(
+            self._counters_key(model), self._field(region, tenant)
+        )
+        if counter is None:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            )
+        return self._public_state(self._state(counter))
+
+    def delete_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        field_count = self.redis_client.hdel(
+            self._counters_key(model), self._field(region, tenant)
+        )
+        if field_count == 0:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            )
+
+    def export_buckets(self, batch_size: int = 1000) -> Iterator[BucketRecord]:
+        prefix = f"{self.namespace}:{{"
+        keys = self.redis_client.scan_iter(
+            match=self._counters_key("*"), count=batch_size
+        )
+        for batch in batched(keys, batch_size):
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key in batch:
+                model = key[len(prefix) : -len("}:counters")]
+                pipeline.hgetall(key)
+                pipeline.hgetall(self._config_key(model))
+            results = pipeline.execute()
+            for key, counters, config in zip(batch, results[::2], results[1::2]):
+                model = key[len(prefix) : -len("}:counters")]
+                for field, counter in counters.items():
+                    state = self._state(counter)
+                    if TENANT_SEPARATOR in field:
+                        region, tenant = field.split(TENANT_SEPARATOR, 1)
+                    else:
+                        region, tenant = field, None
+                        state["meta"] = self._decoded_meta(
+                            model, region, int(counter.split(":")[2]), config[region]
+                        )
+                    yield model, region, tenant, self._public_state(state)
+
+    def import_buckets(
+        self, buckets: Iterable[BucketRecord], batch_size: int = 1000
+    ) -> int:
+        count = 0
+        for batch in batched(buckets, batch_size):
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for model, region, tenant, state in batch:
+                state = self._stored_state(state)
+                pipeline.eval(
+                    PUT_LUA_SCRIPT,
+                    2,
+                    self._counters_key(model),
+                    self._config_key(model),
+                    0,
+                    self._field(region, tenant),
+                    "",
+                    json.dumps(state.get("meta")) if tenant is None else "",
+                    VERSION_FIELD,
+                    *self._counts(state),
+                )
+                if tenant is None:
+                    self._forget_regions(model)
+            pipeline.execute()
+            count += len(batch)
+        return count
+
+    def consume_tokens(self, deltas: dict[BucketKey, int]) -> dict[BucketKey, dict]:
+        models = {}
+        for bucket_key, delta in deltas.items():
+            models.setdefault(bucket_key[0], []).append((bucket_key, delta))
+        if self.gcra:
+            script, now = GCRA_CONSUME_LUA_SCRIPT, self._current_time_us()
+        else:
+            script, now = CONSUME_LUA_SCRIPT, self._current_time()
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for model, model_deltas in models.items():
+            args = []
+            for (_, region, tenant), delta in model_deltas:
+                args.extend([self._field(region, tenant), delta])
+            pipeline.eval(script, 1, self._counters_key(model), now, *args)
+        states = {}
+        settled = set()
+        error = None
+        for model_deltas, counters in zip(
+            models.values(), pipeline.execute(raise_on_error=False)
+        ):
+            if isinstance(counters, Exception):
+                error = counters
+                continue
+            for (bucket_key, _), counter in zip(model_deltas, counters):
+                settled.add(bucket_key)
+                if counter:
+                    states[bucket_key] = self._public_state(self._state(counter))
+        if error is not None:
+            if not settled:
+                raise error
+            raise PartialConsumptionError(
+                f"Consumed {len(settled)} of {len(deltas)} buckets", settled
+            ) from error
+        return states
+
+    def _take_tokens_batch(
+        self,
+        model: Model,
+        region: Region,
+        required_tokens: list[int],
+        tenant: Optional[Tenant] = None,
+    ) -> list[tuple[Optional[dict], Optional[float]]]:
+        if self.gcra:
+            script, now = GCRA_TAKE_LUA_SCRIPT, self._current_time_us()
+        else:
+            script, now = TAKE_LUA_SCRIPT, self._current_time()
+        try:
+            version, *results = self.redis_client.eval(
+                script,
+                1,
+                self._counters_key(model),
+                now,
+                self._field(region),
+                "" if tenant is None else self._field(region, tenant),
+                *required_tokens,
+            )
+        except ResponseError as err:
+            if "Field does not exist" in str(err):
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            raise
+        if version is None:
+            return [(None, None)] * len(required_tokens)
+
+        meta = self._decoded_meta(model, region, version)
+        taken = []
+        for result in results:
+            if result[0]:
+                taken.append((meta, None))
+            elif int(result[1]) < 0:
+                taken.append((None, None))
+            elif self.gcra:
+                taken.append((None, int(result[1]) / MICROSECONDS))
+            else:
+                taken.append((None, int(result[1])))
+        return taken
@@ -1,18 +1,90 @@
+import time
+from typing import Iterable, Iterator, Optional
+
 from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 from mypy_boto3_dynamodb.client import DynamoDBClient
 
-from tbc.abstract_token_bucket_carousel import Model, Region, TokenBucketCarousel
-from tbc.errors import InvalidModelError, InvalidRegionError
+from tbc.abstract_token_bucket_carousel import (
+    BucketKey,
+    BucketRecord,
+    Model,
+    Region,
+    Tenant,
+    TokenBucketCarousel,
+    batched,
+    gcra_consume,
+)
+from tbc.errors import (
+    InvalidModelError,
+    InvalidRegionError,
+    InvalidTenantError,
+    PartialConsumptionError,
+)
 
 serializer = TypeSerializer()
 deserializer = TypeDeserializer()
 
+# Tenant quotas share the model partition, sorted under "<region>#<tenant>"
+TENANT_SEPARATOR = "#"
+# A take is retried when a concurrent writer refills or drains a bucket
+# between our read and our conditional write
+TAKE_TRANSACTION_ATTEMPTS = 3
+# BatchWriteItem accepts at most 25 put requests per call
+BATCH_WRITE_SIZE = 25
+# BatchGetItem and TransactWriteItems accept at most 100 items per call
+TRANSACTION_SIZE = 100
+
 
 class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
-    def __init__(self, dynamodb_client: DynamoDBClient, table_name: str):
-        super().__init__()
+    def __init__(
+        self, dynamodb_client: DynamoDBClient, table_name: str, gcra: bool = False
+    ):
+        super().__init__(gcra=gcra)
         self.dynamodb_client = dynamodb_client
         self.table_name = table_name
+        # (model, region) -> meta last read, for single write tenant takes
+        self.__meta = {}
+
+    def _bucket(self, item: dict) -> dict:
+        bucket = {
+            "token_allowance": int(item["TokenAllowance"]["N"]),
+            "token_refresh_seconds": int(item["TokenRefreshSeconds"]["N"]),
+        }
+        if "TheoreticalArrivalTime" in item:
+            bucket["theoretical_arrival_time_us"] = int(
+                item["TheoreticalArrivalTime"]["N"]
+            )
+        else:
+            bucket["tokens_remaining"] = int(item["TokensRemaining"]["N"])
+            bucket["last_refresh"] = int(item["LastRefresh"]["N"])
+        return bucket
+
+    def _state(self, item: dict) -> dict:
+        state = self._bucket(item)
+        if "Meta" in item:
+            state["meta"] = deserializer.deserialize(item["Meta"])
+        return self._public_state(state)
+
+    def _item(self, model: Model, region: str, state: dict) -> dict:
+        item = {
+            "Model": {"S": model},
+            "Region": {"S": region},
+            "TokenAllowance": {"N": str(state["token_allowance"])},
+            "TokenRefreshSeconds": {"N": str(state["token_refresh_seconds"])},
+        }
+        if self.gcra:
+            item["TheoreticalArrivalTime"] = {
+                "N": str(state["theoretical_arrival_time_us"])
+            }
+        else:
+            item["TokensRemaining"] = {"N": str(state["tokens_remaining"])}
+            item["LastRefresh"] = {"N": str(state["last_refresh"])}
+            item["NextRefresh"] = {
+                "N": str(state["last_refresh"] + state["token_refresh_seconds"])
+            }
+        if "meta" in state:
+            item["Meta"] = serializer.serialize(state["meta"])
+        return item
 
     def list_models(self) -> set[Model]:
         models = set()
@@ -39,16 +111,38 @@ class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
         return models
 
     def list_model_regions(self, model: Model) -> set[Region]:
-        response = self.dynamodb_client.query(
-            TableName=self.table_name,
-            KeyConditionExpression="#model = :model",
-            ExpressionAttributeValues={":model": {"S": model}},
-            ProjectionExpression="#region",
-            ExpressionAttributeNames={"#model": "Model", "#region": "Region"},
-        )
-        if "Items" in response and len(response["Items"]) > 0:
-            return {item["Region"]["S"] for item in response["Items"]}
-        raise InvalidModelError(f"Model {model} does not exist")
+        regions = set()
+        last_evaluated_key = None
+
+        while True:
+            query_kwargs = {
+                "TableName": self.table_name,
+                "KeyConditionExpression": "#model = :model",
+                # Tenant quotas are sorted under the model too
+                "FilterExpression": "NOT contains(#region, :separator)",
+                "ExpressionAttributeValues": {
+                    ":model": {"S": model},
+                    ":separator": {"S": TENANT_SEPARATOR},
+                },
+                "ProjectionExpression": "#region",
+                "ExpressionAttributeNames": {"#model": "Model", "#region": "Region"},
+            }
+
+            if last_evaluated_key:
+                query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+            response = self.dynamodb_client.query(**query_kwargs)
+
+            if "Items" in response:
+                regions.update(item["Region"]["S"] for item in response["Items"])
+
+            last_evaluated_key = response.get("LastEvaluatedKey")
+            if not last_evaluated_key:
+                break
+
+        if not regions:
+            raise InvalidModelError(f"Model {model} does not exist")
+        return regions
 
     def create_model_region(
         self,
@@ -58,23 +152,27 @@ class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
         token_refresh_seconds: int,
         meta: dict,
     ):
+        if TENANT_SEPARATOR in region:
+            raise ValueError(f"Region {region} must not contain {TENANT_SEPARATOR!r}")
         try:
             self.dynamodb_client.put_item(
                 TableName=self.table_name,
-                Item={
-                    "Model": {"S": model},
-                    "Region": {"S": region},
-                    "TokenAllowance": {"N": str(token_allowance)},
-                    "TokenRefreshSeconds": {"N": str(token_refresh_seconds)},
-                    "TokensRemaining": {"N": str(token_allowance)},
-                    "LastRefresh": {"N": str(self._current_time())},
-                    "Meta": serializer.serialize(meta),
-                },
+                Item=self._item(
+                    model,
+                    region,
+                    {
+                        "token_allowance": token_allowance,
+                        "token_refresh_seconds": token_refresh_seconds,
+                        "meta": meta,
+                        **self._new_state(token_allowance),
+                    },
+                ),
                 ConditionExpression="attribute_not_exists(#model) AND attribute_not_exists(#region)",
                 ExpressionAttributeNames={"#model": "Model", "#region": "Region"},
             )
         except self.dynamodb_client.exceptions.ConditionalCheckFailedException as err:
             raise ValueError(f"Model {model} already has region {region}") from err
+        self._forget_regions(model)
 
     def read_model_region(self, model: Model, region: Region):
         response = self.dynamodb_client.get_item(
@@ -83,13 +181,7 @@ class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
         )
         if "Item" not in response:
             raise InvalidRegionError(f"Model {model} does not have region {region}")
-        return {
-            "token_allowance": int(response["Item"]["TokenAllowance"]["N"]),
-            "token_refresh_seconds": int(response["Item"]["TokenRefreshSeconds"]["N"]),
-            "tokens_remaining": int(response["Item"]["TokensRemaining"]["N"]),
-            "last_refresh": int(response["Item"]["LastRefresh"]["N"]),
-            "meta": deserializer.deserialize(response["Item"]["Meta"]),
-        }
+        return self._state(response["Item"])
 
     def update_model_region(
         self,
@@ -99,11 +191,14 @@ class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
         token_refresh_seconds: int,
         meta: dict,
     ):
+        update_expression = "SET TokenAllowance = :token_allowance, TokenRefreshSeconds = :token_refresh_seconds, Meta = :meta"
+        if not self.gcra:
+            update_expression += ", NextRefresh = LastRefresh + :token_refresh_seconds"
         try:
             self.dynamodb_client.update_item(
                 TableName=self.table_name,
                 Key={"Model": {"S": model}, "Region": {"S": region}},
-                UpdateExpression="SET TokenAllowance = :token_allowance, TokenRefreshSeconds = :token_refresh_seconds, Meta = :meta",
+                UpdateExpression=update_expression,
                 ExpressionAttributeValues={
                     ":token_allowance": {"N": str(token_allowance)},
                     ":token_refresh_seconds": {"N": str(token_refresh_seconds)},
@@ -116,6 +211,7 @@ class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
             raise InvalidRegionError(
                 f"Model {model} does not have region {region}"
             ) from err
+        self._reset_region(model, region)
 
     def delete_model_region(self, model: Model, region: Region):
         try:
@@ -129,13 +225,63 @@ class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
             raise InvalidRegionError(
                 f"Model {model} does not have region {region}"
             ) from err
+        self._delete_tenant_quotas(model, region)
+        self._forget_regions(model)
+
+    def _delete_tenant_quotas(self, model: Model, region: Region):
+        last_evaluated_key = None
+        while True:
+            query_kwargs = {
+                "TableName": self.table_name,
+                "KeyConditionExpression": "#model = :model AND begins_with(#region, :prefix)",
+                "ExpressionAttributeValues": {
+                    ":model": {"S": model},
+                    ":prefix": {"S": f"{region}{TENANT_SEPARATOR}"},
+                },
+                "ProjectionExpression": "#model, #region",
+                "ExpressionAttributeNames": {"#model": "Model", "#region": "Region"},
+            }
+            if last_evaluated_key:
+                query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+            response = self.dynamodb_client.query(**query_kwargs)
+            for batch in batched(response.get("Items", []), BATCH_WRITE_SIZE):
+                self._batch_write([{"DeleteRequest": {"Key": key}} for key in batch])
+
+            last_evaluated_key = response.get("LastEvaluatedKey")
+            if not last_evaluated_key:
+                break
 
     def replenish_tokens(self, model: Model, region: Region):
+        if self.gcra:
+            try:
+                self.dynamodb_client.update_item(
+                    TableName=self.table_name,
+                    Key={"Model": {"S": model}, "Region": {"S": region}},
+                    UpdateExpression="SET #tat = :now",
+                    ExpressionAttributeValues={
+                        ":now": {"N": str(self._current_time_us())}
+                    },
+                    ConditionExpression="attribute_exists(#model) AND attribute_exists(#region)",
+                    ExpressionAttributeNames={
+                        "#model": "Model",
+                        "#region": "Region",
+                        "#tat": "TheoreticalArrivalTime",
+                    },
+                )
+            except (
+                self.dynamodb_client.exceptions.ConditionalCheckFailedException
+            ) as err:
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            self._reset_region(model, region)
+            return
         try:
             self.dynamodb_client.update_item(
                 TableName=self.table_name,
                 Key={"Model": {"S": model}, "Region": {"S": region}},
-                UpdateExpression="SET TokenAllowance = TokensRemaining, #last_refresh = :now",
+                UpdateExpression="SET TokensRemaining = TokenAllowance, #last_refresh = :now, NextRefresh = :now + TokenRefreshSeconds",
                 ExpressionAttributeValues={":now": {"N": str(self._current_time())}},
                 ConditionExpression="attribute_exists(#model) AND attribute_exists(#region) AND #last_refresh < :now",
                 ExpressionAttributeNames={
@@ -149,13 +295,464 @@ class DynamoDBTokenBucketCarousel(TokenBucketCarousel):
             raise InvalidRegionError(
                 f"Model {model} does not have region {region}"
             ) from err
+        self._reset_region(model, region)
+
+    def _tenant_region(self, region: Region, tenant: Tenant) -> str:
+        return f"{region}{TENANT_SEPARATOR}{tenant}"
+
+    def create_tenant_quota(
+        self,
+        model: Model,
+        region: Region,
+        tenant: Tenant,
+        token_allowance: int,
+        token_refresh_seconds: int,
+    ):
+        try:
+            self.dynamodb_client.transact_write_items(
+                TransactItems=[
+                    {
+                        "ConditionCheck": {
+                            "TableName": self.table_name,
+                            "Key": {"Model": {"S": model}, "Region": {"S": region}},
+                            "ConditionExpression": "attribute_exists(#model)",
+                            "ExpressionAttributeNames": {"#model": "Model"},
+                        }
+                    },
+                    {
+                        "Put": {
+                            "TableName": self.table_name,
+                            "Item": self._item(
+                                model,
+                                self._tenant_region(region, tenant),
+                                {
+                                    "token_allowance": token_allowance,
+                                    "token_refresh_seconds": token_refresh_seconds,
+                                    **self._new_state(token_allowance),
+                                },
+                            ),
+                            "ConditionExpression": "attribute_not_exists(#model)",
+                            "ExpressionAttributeNames": {"#model": "Model"},
+                        }
+                    },
+                ]
+            )
+        except self.dynamodb_client.exceptions.TransactionCanceledException as err:
+            reasons = [reason["Code"] for reason in err.response["CancellationReasons"]]
+            if reasons[0] == "ConditionalCheckFailed":
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            if reasons[1] == "ConditionalCheckFailed":
+                raise ValueError(
+                    f"Model {model} region {region} already has tenant {tenant}"
+                ) from err
+            raise
+
+    def read_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={
+                "Model": {"S": model},
+                "Region": {"S": self._tenant_region(region, tenant)},
+            },
+        )
+        if "Item" not in response:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            )
+        return self._state(response["Item"])
+
+    def delete_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        try:
+            self.dynamodb_client.delete_item(
+                TableName=self.table_name,
+                Key={
+                    "Model": {"S": model},
+                    "Region": {"S": self._tenant_region(region, tenant)},
+                },
+                ConditionExpression="attribute_exists(#model) AND attribute_exists(#region)",
+                ExpressionAttributeNames={"#model": "Model", "#region": "Region"},
+            )
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException as err:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            ) from err
+
+    def export_buckets(self, batch_size: int = 1000) -> Iterator[BucketRecord]:
+        last_evaluated_key = None
+
+        while True:
+            scan_kwargs = {"TableName": self.table_name, "Limit": batch_size}
+
+            if last_evaluated_key:
+                scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+            response = self.dynamodb_client.scan(**scan_kwargs)
+
+            for item in response.get("Items", []):
+                region, _, tenant = item["Region"]["S"].partition(TENANT_SEPARATOR)
+                yield item["Model"]["S"], region, tenant or None, self._state(item)
+
+            last_evaluated_key = response.get("LastEvaluatedKey")
+            if not last_evaluated_key:
+                break
+
+    def import_buckets(
+        self, buckets: Iterable[BucketRecord], batch_size: int = 1000
+    ) -> int:
+        count = 0
+        for batch in batched(buckets, min(batch_size, BATCH_WRITE_SIZE)):
+            requests = []
+            for model, region, tenant, state in batch:
+                if tenant is not None:
+                    region = self._tenant_region(region, tenant)
+                else:
+                    self._forget_regions(model)
+                requests.append(
+                    {
+                        "PutRequest": {
+                            "Item": self._item(model, region, self._stored_state(state))
+                        }
+                    }
+                )
+
+            self._batch_write(requests)
+            count += len(batch)
+        return count
+
+    def _batch_write(self, requests: list[dict]):
+        delay = 0.05
+        while requests:
+            response = self.dynamodb_client.batch_write_item(
+                RequestItems={self.table_name: requests}
+            )
+            requests = response.get("UnprocessedItems", {}).get(self.table_name)
+            if requests:
+                time.sleep(delay)
+                delay = min(delay * 2, 1)
+
+    def consume_tokens(self, deltas: dict[BucketKey, int]) -> dict[BucketKey, dict]:
+        states = {}
+        settled = set()
+        for batch in batched(deltas.items(), TRANSACTION_SIZE):
+            batch = dict(batch)
+            try:
+                states.update(self._consume_batch(batch))
+            except Exception as err:
+                if not settled:
+                    raise
+                raise PartialConsumptionError(
+                    f"Consumed {len(settled)} of {len(deltas)} buckets", settled
+                ) from err
+            settled.update(batch)
+        return states
+
+    def _consume_batch(self, deltas: dict[BucketKey, int]) -> dict[BucketKey, dict]:
+        keys = {
+            (model, region, tenant): {
+                "Model": {"S": model},
+                "Region": {
+                    "S": region
+                    if tenant is None
+                    else self._tenant_region(region, tenant)
+                },
+            }
+            for model, region, tenant in deltas
+        }
+
+        for _ in range(TAKE_TRANSACTION_ATTEMPTS):
+            items = {
+                (item["Model"]["S"], item["Region"]["S"]): item
+                for item in self._batch_get_items(list(keys.values()))
+            }
+
+            states = {}
+            updates = []
+            for bucket_key, key in keys.items():
+                item = items.get((key["Model"]["S"], key["Region"]["S"]))
+                if item is None:
+                    continue
+                old_state = self._state(item)
+                state = self._consumed_state(old_state, deltas[bucket_key])
+                states[bucket_key] = state
+                if not deltas[bucket_key]:
+                    # Refills are applied lazily, so an idle bucket needs no write
+                    continue
+                if self.gcra:
+                    updates.append(
+                        {
+                            "Update": {
+                                "TableName": self.table_name,
+                                "Key": key,
+                                "UpdateExpression": "SET #tat = :new_tat",
+                                "ConditionExpression": "#tat = :tat",
+                                "ExpressionAttributeNames": {
+                                    "#tat": "TheoreticalArrivalTime"
+                                },
+                                "ExpressionAttributeValues": {
+                                    ":tat": item["TheoreticalArrivalTime"],
+                                    ":new_tat": {
+                                        "N": str(state["theoretical_arrival_time_us"])
+                                    },
+                                },
+                            }
+                        }
+                    )
+                else:
+                    updates.append(
+                        {
+                            "Update": {
+                                "TableName": self.table_name,
+                                "Key": key,
+                                "UpdateExpression": "SET #tokens_remaining = :new_remaining, #last_refresh = :new_last_refresh, NextRefresh = :next_refresh",
+                                "ConditionExpression": "#tokens_remaining = :remaining AND #last_refresh = :last_refresh",
+                                "ExpressionAttributeNames": {
+                                    "#tokens_remaining": "TokensRemaining",
+                                    "#last_refresh": "LastRefresh",
+                                },
+                                "ExpressionAttributeValues": {
+                                    ":remaining": item["TokensRemaining"],
+                                    ":last_refresh": item["LastRefresh"],
+                                    ":new_remaining": {
+                                        "N": str(state["tokens_remaining"])
+                                    },
+                                    ":new_last_refresh": {
+                                        "N": str(state["last_refresh"])
+                                    },
+                                    ":next_refresh": {
+                                        "N": str(
+                                            state["last_refresh"]
+                                            + state["token_refresh_seconds"]
+                                        )
+                                    },
+                                },
+                            }
+                        }
+                    )
+
+            if not updates:
+                return states
+            try:
+                self.dynamodb_client.transact_write_items(TransactItems=updates)
+            except self.dynamodb_client.exceptions.TransactionCanceledException:
+                continue
+            return states
 
-    async def request_tokens(
+        raise RuntimeError("Could not consume tokens due to concurrent updates")
+
+    def _batch_get_items(self, keys: list[dict]) -> list[dict]:
+        items = []
+        request = {self.table_name: {"Keys": keys, "ConsistentRead": True}}
+        while request:
+            response = self.dynamodb_client.batch_get_item(RequestItems=request)
+            items.extend(response["Responses"].get(self.table_name, []))
+            request = response.get("UnprocessedKeys")
+        return items
+
+    def _consumed_state(self, state: dict, tokens: int) -> dict:
+        state = {key: value for key, value in state.items() if key != "meta"}
+        if self.gcra:
+            state["theoretical_arrival_time_us"] = gcra_consume(
+                state["token_allowance"],
+                state["token_refresh_seconds"],
+                state["theoretical_arrival_time_us"],
+                tokens,
+                self._current_time_us(),
+            )
+            return self._public_state(state)
+        now = self._current_time()
+        if now >= state["last_refresh"] + state["token_refresh_seconds"]:
+            state["tokens_remaining"] = state["token_allowance"]
+            state["last_refresh"] = now
+        state["tokens_remaining"] = max(state["tokens_remaining"] - tokens, 0)
+        return state
+
+    def _take_tokens_batch(
         self,
         model: Model,
-        required_tokens: int,
-        fallback_models: set[Model],
-        allowed_regions: set[Region],
-        preferred_region: Region,
-    ) -> dict:
-        raise NotImplementedError
+        region: Region,
+        required_tokens: list[int],
+        tenant: Optional[Tenant] = None,
+    ) -> list[tuple[Optional[dict], Optional[float]]]:
+        keys = [{"Model": {"S": model}, "Region": {"S": region}}]
+        if tenant is not None:
+            keys.append(
+                {
+                    "Model": {"S": model},
+                    "Region": {"S": self._tenant_region(region, tenant)},
+                }
+            )
+
+        if not self.gcra:
+            meta = self._take_all(model, region, keys, sum(required_tokens))
+            if meta is not None:
+                return [(meta, None)] * len(required_tokens)
+
+        for _ in range(TAKE_TRANSACTION_ATTEMPTS):
+            items = self._get_items(keys)
+            if items[0] is None:
+                raise InvalidRegionError(f"Model {model} does not have region {region}")
+            if None in items:
+                return [(None, None)] * len(required_tokens)
+            meta = self.__meta[(model, region)] = deserializer.deserialize(
+                items[0]["Meta"]
+            )
+
+            # Grant against local copies, then write back the granted total
+            # conditioned on nobody having written the buckets since our read
+            buckets = [self._bucket(item) for item in items]
+            results = self._grant_tokens(buckets, required_tokens)
+            granted = sum(
+                tokens for tokens, (taken, _) in zip(required_tokens, results) if taken
+            )
+            if granted and not self._write_updates(
+                [
+                    self._take_update(key, item, bucket, granted)
+                    for key, item, bucket in zip(keys, items, buckets)
+                ]
+            ):
+                continue
+            return [
+                (meta, None) if taken else (None, retry_after)
+                for taken, retry_after in results
+            ]
+
+        raise RuntimeError("Could not take tokens due to concurrent updates")
+
+    def _take_all(
+        self, model: Model, region: Region, keys: list[dict], total: int
+    ) -> Optional[dict]:
+        """Take tokens from buckets not due a refill, in one conditional write
+
+        Returns:
+            Optional[dict]: The region meta, or None if a bucket is short of
+                tokens, due a refill or missing, or no meta is cached for a
+                tenant take
+        """
+        update = {
+            "TableName": self.table_name,
+            "Key": keys[0],
+            "UpdateExpression": "SET #tokens_remaining = #tokens_remaining - :total",
+            "ConditionExpression": "#tokens_remaining >= :total AND #next_refresh > :now",
+            "ExpressionAttributeNames": {
+                "#tokens_remaining": "TokensRemaining",
+                "#next_refresh": "NextRefresh",
+            },
+            "ExpressionAttributeValues": {
+                ":total": {"N": str(total)},
+                ":now": {"N": str(self._current_time())},
+            },
+        }
+        if len(keys) == 1:
+            try:
+                response = self.dynamodb_client.update_item(
+                    ReturnValues="ALL_NEW", **update
+                )
+            except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+                return None
+            meta = deserializer.deserialize(response["Attributes"]["Meta"])
+            self.__meta[(model, region)] = meta
+            return meta
+
+        # A transaction cannot return the region meta, so the cached one is
+        # used and the write conditioned on it still being current
+        meta = self.__meta.get((model, region))
+        if meta is None:
+            return None
+        region_update = {
+            **update,
+            "ConditionExpression": update["ConditionExpression"] + " AND #meta = :meta",
+            "ExpressionAttributeNames": {
+                **update["ExpressionAttributeNames"],
+                "#meta": "Meta",
+            },
+            "ExpressionAttributeValues": {
+                **update["ExpressionAttributeValues"],
+                ":meta": serializer.serialize(meta),
+            },
+        }
+        if not self._write_updates([region_update, {**update, "Key": keys[1]}]):
+            return None
+        return meta
+
+    def _get_items(self, keys: list[dict]) -> list[Optional[dict]]:
+        if len(keys) == 1:
+            response = self.dynamodb_client.get_item(
+                TableName=self.table_name, Key=keys[0], ConsistentRead=True
+            )
+            return [response.get("Item")]
+        response = self.dynamodb_client.transact_get_items(
+            TransactItems=[
+                {"Get": {"TableName": self.table_name, "Key": key}} for key in keys
+            ]
+        )
+        return [item.get("Item") for item in response["Responses"]]
+
+    def _write_updates(self, updates: list[dict]) -> bool:
+        """Apply conditional updates atomically, False if a condition failed"""
+        try:
+            if len(updates) == 1:
+                self.dynamodb_client.update_item(**updates[0])
+            else:
+                self.dynamodb_client.transact_write_items(
+                    TransactItems=[{"Update": update} for update in updates]
+                )
+        except (
+            self.dynamodb_client.exceptions.ConditionalCheckFailedException,
+            self.dynamodb_client.exceptions.TransactionCanceledException,
+        ):
+            return False
+        return True
+
+    def _take_update(self, key: dict, item: dict, bucket: dict, granted: int) -> dict:
+        if self.gcra:
+            return {
+                "TableName": self.table_name,
+                "Key": key,
+                "UpdateExpression": "SET #tat = :new_tat",
+                "ConditionExpression": "#tat = :tat",
+                "ExpressionAttributeNames": {"#tat": "TheoreticalArrivalTime"},
+                "ExpressionAttributeValues": {
+                    ":tat": item["TheoreticalArrivalTime"],
+                    ":new_tat": {"N": str(bucket["theoretical_arrival_time_us"])},
+                },
+            }
+
+        update = {
+            "TableName": self.table_name,
+            "Key": key,
+            "ExpressionAttributeNames": {
+                "#tokens_remaining": "TokensRemaining",
+                "#last_refresh": "LastRefresh",
+                "#next_refresh": "NextRefresh",
+            },
+            "ExpressionAttributeValues": {
+                ":last_refresh": item["LastRefresh"],
+                ":next_refresh": {
+                    "N": str(bucket["last_refresh"] + bucket["token_refresh_seconds"])
+                },
+            },
+        }
+        if bucket["last_refresh"] != int(item["LastRefresh"]["N"]):
+            # Refilled by this take, so the stored count is stale
+            update[
+                "UpdateExpression"
+            ] = "SET #tokens_remaining = :remaining, #last_refresh = :now, #next_refresh = :next_refresh"
+            update["ConditionExpression"] = "#last_refresh = :last_refresh"
+            update["ExpressionAttributeValues"][":remaining"] = {
+                "N": str(bucket["tokens_remaining"])
+            }
+            update["ExpressionAttributeValues"][":now"] = {
+                "N": str(bucket["last_refresh"])
+            }
+        else:
+            # Also sets the next refresh on items written before it was stored
+            update[
+                "UpdateExpression"
+            ] = "SET #tokens_remaining = #tokens_remaining - :granted, #next_refresh = :next_refresh"
+            update[
+                "ConditionExpression"
+            ] = "#last_refresh = :last_refresh AND #tokens_remaining >= :granted"
+            update["ExpressionAttributeValues"][":granted"] = {"N": str(granted)}
+        return update
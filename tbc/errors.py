@@ -8,3 +8,33 @@ class InvalidRegionError(Exception):
     """Raised when an invalid region is passed to a function."""
 
     pass
+
+
+class InvalidTenantError(Exception):
+    """Raised when an invalid tenant is passed to a function."""
+
+    pass
+
+
+class InsufficientTokensError(Exception):
+    """Raised when no bucket in the carousel can satisfy a token request.
+
+    retry_after is the number of seconds until the soonest candidate bucket
+    could grant the request, or None if none of them ever can.
+    """
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PartialConsumptionError(Exception):
+    """Raised when consume_tokens fails after settling some of the deltas.
+
+    settled holds the keys of the buckets whose deltas were applied, which
+    must not be consumed again.
+    """
+
+    def __init__(self, message: str, settled: set = None):
+        super().__init__(message)
+        self.settled = settled or set()
@@ -0,0 +1,352 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Iterable, Iterator, Optional
+
+from tbc.abstract_token_bucket_carousel import (
+    BucketKey,
+    BucketRecord,
+    Model,
+    Region,
+    Tenant,
+    TokenBucketCarousel,
+)
+from tbc.errors import (
+    InvalidRegionError,
+    InvalidTenantError,
+    PartialConsumptionError,
+)
+from tbc.inmemory_token_bucket_carousel import InMemoryTokenBucketCarousel
+
+logger = logging.getLogger(__name__)
+
+
+class HybridTokenBucketCarousel(TokenBucketCarousel):
+    """Serves tokens from an in-process mirror of an authoritative carousel
+
+    Tokens are taken from a local InMemoryTokenBucketCarousel, so the request
+    path does no network I/O. The consumption is aggregated and settled with
+    the backend by sync(), in one consume_tokens call, which also pulls back
+    the global remaining counts.
+
+    Each node mirrors node_share of every bucket's allowance and remaining
+    tokens, e.g. 1/N for N nodes, which bounds how far the nodes together can
+    overdraw a bucket between syncs. Shares are rounded down, but a node gets
+    at least one token of a non-empty bucket.
+
+    If no sync has succeeded within max_staleness_seconds the next request
+    syncs inline before it is served. A failed inline sync is logged and not
+    retried inline for another max_staleness_seconds, requests being served
+    from the mirror meanwhile.
+
+    Models are mirrored on first use, or all at once with load(). CRUD calls
+    go straight to the backend and refresh the mirror.
+    """
+
+    def __init__(
+        self,
+        backend: TokenBucketCarousel,
+        node_share: float = 1.0,
+        max_staleness_seconds: float = 5.0,
+    ):
+        super().__init__()
+        self.backend = backend
+        self.node_share = node_share
+        self.max_staleness_seconds = max_staleness_seconds
+        self.__mirror = InMemoryTokenBucketCarousel()
+        # Mirrored bucket keys, with the meta of region buckets
+        self.__mirrored = {}
+        self.__missing_tenants = set()
+        self.__deltas = {}
+        self.__last_sync = None
+        self.__sync_retry_at = None
+
+    def _monotonic_time(self):
+        return time.monotonic()
+
+    def list_models(self) -> set[Model]:
+        return self.backend.list_models()
+
+    def list_model_regions(self, model: Model) -> set[Region]:
+        return self.backend.list_model_regions(model)
+
+    def create_model_region(
+        self,
+        model: Model,
+        region: Region,
+        token_allowance: int,
+        token_refresh_seconds: int,
+        meta: dict,
+    ):
+        self.backend.create_model_region(
+            model, region, token_allowance, token_refresh_seconds, meta
+        )
+        self._forget_regions(model)
+        self.__refresh_bucket((model, region, None))
+
+    def read_model_region(self, model: Model, region: Region):
+        return self.backend.read_model_region(model, region)
+
+    def update_model_region(
+        self,
+        model: Model,
+        region: Region,
+        token_allowance: int,
+        token_refresh_seconds: int,
+        meta: dict,
+    ):
+        self.backend.update_model_region(
+            model, region, token_allowance, token_refresh_seconds, meta
+        )
+        self._reset_region(model, region)
+        self.__refresh_bucket((model, region, None))
+
+    def delete_model_region(self, model: Model, region: Region):
+        self.backend.delete_model_region(model, region)
+        self._forget_regions(model)
+        self.__forget_bucket((model, region, None))
+
+    def replenish_tokens(self, model: Model, region: Region):
+        self.backend.replenish_tokens(model, region)
+        self._reset_region(model, region)
+        self.__refresh_bucket((model, region, None))
+
+    def create_tenant_quota(
+        self,
+        model: Model,
+        region: Region,
+        tenant: Tenant,
+        token_allowance: int,
+        token_refresh_seconds: int,
+    ):
+        self.backend.create_tenant_quota(
+            model, region, tenant, token_allowance, token_refresh_seconds
+        )
+        self.__missing_tenants.discard((model, region, tenant))
+        self.__refresh_bucket((model, region, tenant))
+
+    def read_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        return self.backend.read_tenant_quota(model, region, tenant)
+
+    def delete_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        self.backend.delete_tenant_quota(model, region, tenant)
+        self.__forget_bucket((model, region, tenant))
+
+    def export_buckets(self, batch_size: int = 1000) -> Iterator[BucketRecord]:
+        return self.backend.export_buckets(batch_size)
+
+    def import_buckets(
+        self, buckets: Iterable[BucketRecord], batch_size: int = 1000
+    ) -> int:
+        count = self.backend.import_buckets(buckets, batch_size)
+        self._models.clear()
+        self.sync()
+        return count
+
+    def consume_tokens(self, deltas: dict[BucketKey, int]) -> dict[BucketKey, dict]:
+        return self.backend.consume_tokens(deltas)
+
+    def load(self, batch_size: int = 1000) -> int:
+        """Mirror every bucket and tenant quota of the backend
+
+        Args:
+            batch_size (int): Number of buckets fetched from the backend at once
+
+        Returns:
+            int: Number of buckets mirrored
+        """
+        count = 0
+        for model, region, tenant, state in self.backend.export_buckets(batch_size):
+            self.__mirror_state((model, region, tenant), state)
+            count += 1
+        self.__last_sync = self._monotonic_time()
+        return count
+
+    def sync(self):
+        """Settle local consumption with the backend and pull back its counts
+
+        Raises:
+            Exception: Whatever the backend raised; the unsettled consumption
+                is kept for the next sync
+        """
+        deltas, request = self.__start_sync()
+        try:
+            states = self.backend.consume_tokens(request)
+        except Exception as err:
+            self.__keep_unsettled(deltas, err)
+            raise
+        self.__finish_sync(request, states)
+
+    async def run(self, interval_seconds: float = 0.1):
+        """Sync with the backend every interval until cancelled
+
+        The backend is called in a worker thread, so requests keep being
+        served from the mirror while a sync is in flight.
+
+        Args:
+            interval_seconds (float): Time in seconds between syncs
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval_seconds)
+            deltas, request = self.__start_sync()
+            call = loop.run_in_executor(None, self.backend.consume_tokens, request)
+            # Settled on the loop once the backend returns, even if run is
+            # cancelled meanwhile, as the call itself cannot be
+            call.add_done_callback(functools.partial(self.__settle, deltas, request))
+            await asyncio.wait([call])
+
+    def __settle(
+        self,
+        deltas: dict[BucketKey, int],
+        request: dict[BucketKey, int],
+        call: asyncio.Future,
+    ):
+        try:
+            states = call.result()
+        except Exception as err:
+            self.__keep_unsettled(deltas, err)
+            logger.exception("Failed to sync token bucket carousel")
+            return
+        self.__finish_sync(request, states)
+
+    def __start_sync(self) -> tuple[dict[BucketKey, int], dict[BucketKey, int]]:
+        deltas, self.__deltas = self.__deltas, {}
+        return deltas, {key: deltas.get(key, 0) for key in self.__mirrored}
+
+    def __keep_unsettled(self, deltas: dict[BucketKey, int], err: Exception):
+        settled = err.settled if isinstance(err, PartialConsumptionError) else ()
+        for key, delta in deltas.items():
+            if key not in settled:
+                self.__deltas[key] = self.__deltas.get(key, 0) + delta
+
+    def __finish_sync(
+        self, request: dict[BucketKey, int], states: dict[BucketKey, dict]
+    ):
+        for key in request:
+            # Buckets forgotten while the backend was called stay forgotten
+            if key not in self.__mirrored:
+                continue
+            if key in states:
+                self.__mirror_state(key, states[key])
+            else:
+                self.__forget_bucket(key)
+                if key[2] is None:
+                    self._forget_regions(key[0])
+            # The global counts may have freed up regions skipped as exhausted
+            self._reset_region(key[0], key[1])
+        self.__missing_tenants.clear()
+        self.__last_sync = self._monotonic_time()
+        self.__sync_retry_at = None
+
+    async def request_tokens(
+        self,
+        model: Model,
+        required_tokens: int,
+        fallback_models: set[Model] = None,
+        allowed_regions: set[Region] = None,
+        preferred_region: Region = None,
+        tenant: Tenant = None,
+    ) -> dict:
+        self.__sync_if_stale()
+        return await super().request_tokens(
+            model,
+            required_tokens,
+            fallback_models,
+            allowed_regions,
+            preferred_region,
+            tenant,
+        )
+
+    def __sync_if_stale(self):
+        now = self._monotonic_time()
+        if (
+            self.__last_sync is not None
+            and now - self.__last_sync <= self.max_staleness_seconds
+        ):
+            return
+        if self.__sync_retry_at is not None and now < self.__sync_retry_at:
+            return
+        try:
+            self.sync()
+        except Exception:
+            logger.exception("Failed to sync token bucket carousel")
+            self.__sync_retry_at = now + self.max_staleness_seconds
+
+    def _take_tokens_batch(
+        self,
+        model: Model,
+        region: Region,
+        required_tokens: list[int],
+        tenant: Optional[Tenant] = None,
+    ) -> list[tuple[Optional[dict], Optional[float]]]:
+        keys = [(model, region, None)]
+        if tenant is not None:
+            keys.append((model, region, tenant))
+        for key in keys:
+            if key in self.__mirrored:
+                continue
+            if key in self.__missing_tenants:
+                return [(None, None)] * len(required_tokens)
+            try:
+                self.__refresh_bucket(key)
+            except InvalidTenantError:
+                self.__missing_tenants.add(key)
+                return [(None, None)] * len(required_tokens)
+
+        results = self.__mirror._take_tokens_batch(
+            model, region, required_tokens, tenant
+        )
+        granted = sum(
+            tokens
+            for tokens, (meta, _) in zip(required_tokens, results)
+            if meta is not None
+        )
+        if granted:
+            for key in keys:
+                self.__deltas[key] = self.__deltas.get(key, 0) + granted
+        return results
+
+    def __refresh_bucket(self, key: BucketKey):
+        model, region, tenant = key
+        if tenant is None:
+            state = self.backend.read_model_region(model, region)
+        else:
+            state = self.backend.read_tenant_quota(model, region, tenant)
+        self.__mirror_state(key, state)
+
+    def __mirror_state(self, key: BucketKey, state: dict):
+        model, region, tenant = key
+        if tenant is None and "meta" not in state:
+            state = {**state, "meta": self.__mirrored[key]}
+        local_state = {
+            "token_allowance": self.__share(state["token_allowance"]),
+            "token_refresh_seconds": state["token_refresh_seconds"],
+            "tokens_remaining": max(
+                self.__share(state["tokens_remaining"]) - self.__deltas.get(key, 0),
+                0,
+            ),
+            "last_refresh": state.get("last_refresh", self._current_time()),
+        }
+        if tenant is None:
+            local_state["meta"] = state["meta"]
+        self.__mirror.import_buckets([(model, region, tenant, local_state)])
+        self.__mirrored[key] = state.get("meta")
+
+    def __share(self, tokens: int) -> int:
+        # At least one token of a non-empty bucket, or a node could never
+        # grant from buckets smaller than 1 / node_share
+        return max(int(tokens * self.node_share), min(tokens, 1))
+
+    def __forget_bucket(self, key: BucketKey):
+        model, region, tenant = key
+        self.__mirrored.pop(key, None)
+        self.__deltas.pop(key, None)
+        try:
+            if tenant is None:
+                self.__mirror.delete_model_region(model, region)
+            else:
+                self.__mirror.delete_tenant_quota(model, region, tenant)
+        except (InvalidRegionError, InvalidTenantError):
+            pass
@@ -1,11 +1,22 @@
-from tbc.abstract_token_bucket_carousel import Model, Region, TokenBucketCarousel
-from tbc.errors import InvalidModelError, InvalidRegionError
+from typing import Iterable, Iterator, Optional
+
+from tbc.abstract_token_bucket_carousel import (
+    BucketKey,
+    BucketRecord,
+    Model,
+    Region,
+    Tenant,
+    TokenBucketCarousel,
+    gcra_consume,
+)
+from tbc.errors import InvalidModelError, InvalidRegionError, InvalidTenantError
 
 
 class InMemoryTokenBucketCarousel(TokenBucketCarousel):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, gcra: bool = False):
+        super().__init__(gcra=gcra)
         self.__data = {}
+        self.__tenants = {}
 
     def list_models(self) -> set[Model]:
         return set(self.__data.keys())
@@ -32,14 +43,14 @@ class InMemoryTokenBucketCarousel(TokenBucketCarousel):
             "token_allowance": token_allowance,
             "token_refresh_seconds": token_refresh_seconds,
             "meta": meta,
-            "tokens_remaining": token_allowance,
-            "last_refresh": self._current_time(),
+            **self._new_state(token_allowance),
         }
+        self._forget_regions(model)
 
     def read_model_region(self, model: Model, region: Region):
         if model not in self.__data or region not in self.__data[model]:
             raise InvalidRegionError(f"Model {model} does not have region {region}")
-        return self.__data[model][region]
+        return self._public_state(self.__data[model][region])
 
     def update_model_region(
         self,
@@ -54,39 +65,131 @@ class InMemoryTokenBucketCarousel(TokenBucketCarousel):
         self.__data[model][region]["token_allowance"] = token_allowance
         self.__data[model][region]["token_refresh_seconds"] = token_refresh_seconds
         self.__data[model][region]["meta"] = meta
+        self._reset_region(model, region)
 
     def delete_model_region(self, model: Model, region: Region):
         if model not in self.__data or region not in self.__data[model]:
             raise InvalidRegionError(f"Model {model} does not have region {region}")
         del self.__data[model][region]
+        if not self.__data[model]:
+            del self.__data[model]
+        self.__tenants.pop((model, region), None)
+        self._forget_regions(model)
 
     def replenish_tokens(self, model: Model, region: Region):
         if model not in self.__data or region not in self.__data[model]:
             raise InvalidRegionError(f"Model {model} does not have region {region}")
-        self.__data[model][region]["tokens_remaining"] = self.__data[model][region][
-            "token_allowance"
-        ]
-        self.__data[model][region]["last_refresh"] = self._current_time()
+        bucket = self.__data[model][region]
+        if self.gcra:
+            bucket["theoretical_arrival_time_us"] = self._current_time_us()
+        else:
+            bucket["tokens_remaining"] = bucket["token_allowance"]
+            bucket["last_refresh"] = self._current_time()
+        self._reset_region(model, region)
 
-    async def request_tokens(
+    def create_tenant_quota(
         self,
         model: Model,
-        required_tokens: int,
-        fallback_models: set[Model] = None,
-        allowed_regions: set[Region] = None,
-        preferred_region: Region = None,
-    ) -> dict:
-        region = None
-        if model not in self.__data:
-            raise InvalidModelError(f"Model {model} does not exist")
-        if allowed_regions is None or len(allowed_regions) == 0:
-            allowed_regions = set(self.__data[model].keys())
-        if preferred_region is not None and preferred_region in allowed_regions:
-            region = preferred_region
-        else:
-            for r in allowed_regions:
-                if self.__data[model][r]["tokens_remaining"] >= required_tokens:
-                    region = r
-                    break
-        self.__data[model][region]["tokens_remaining"] -= required_tokens
-        return self.__data[model][region]["meta"]
+        region: Region,
+        tenant: Tenant,
+        token_allowance: int,
+        token_refresh_seconds: int,
+    ):
+        if model not in self.__data or region not in self.__data[model]:
+            raise InvalidRegionError(f"Model {model} does not have region {region}")
+        tenants = self.__tenants.setdefault((model, region), {})
+        if tenant in tenants:
+            raise ValueError(
+                f"Model {model} region {region} already has tenant {tenant}"
+            )
+        tenants[tenant] = {
+            "token_allowance": token_allowance,
+            "token_refresh_seconds": token_refresh_seconds,
+            **self._new_state(token_allowance),
+        }
+
+    def read_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        try:
+            return self._public_state(self.__tenants[(model, region)][tenant])
+        except KeyError as err:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            ) from err
+
+    def delete_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        try:
+            del self.__tenants[(model, region)][tenant]
+        except KeyError as err:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            ) from err
+
+    def export_buckets(self, batch_size: int = 1000) -> Iterator[BucketRecord]:
+        for model, regions in list(self.__data.items()):
+            for region, state in list(regions.items()):
+                yield model, region, None, dict(self._public_state(state))
+        for (model, region), tenants in list(self.__tenants.items()):
+            for tenant, state in list(tenants.items()):
+                yield model, region, tenant, dict(self._public_state(state))
+
+    def import_buckets(
+        self, buckets: Iterable[BucketRecord], batch_size: int = 1000
+    ) -> int:
+        count = 0
+        for model, region, tenant, state in buckets:
+            state = self._stored_state(state)
+            if tenant is None:
+                self.__data.setdefault(model, {})[region] = state
+                self._forget_regions(model)
+            else:
+                self.__tenants.setdefault((model, region), {})[tenant] = state
+            count += 1
+        return count
+
+    def consume_tokens(self, deltas: dict[BucketKey, int]) -> dict[BucketKey, dict]:
+        states = {}
+        now = self._current_time()
+        now_us = self._current_time_us()
+        for (model, region, tenant), delta in deltas.items():
+            if tenant is None:
+                bucket = self.__data.get(model, {}).get(region)
+            else:
+                bucket = self.__tenants.get((model, region), {}).get(tenant)
+            if bucket is None:
+                continue
+            if self.gcra:
+                bucket["theoretical_arrival_time_us"] = gcra_consume(
+                    bucket["token_allowance"],
+                    bucket["token_refresh_seconds"],
+                    bucket["theoretical_arrival_time_us"],
+                    delta,
+                    now_us,
+                )
+            else:
+                if now >= bucket["last_refresh"] + bucket["token_refresh_seconds"]:
+                    bucket["tokens_remaining"] = bucket["token_allowance"]
+                    bucket["last_refresh"] = now
+                bucket["tokens_remaining"] = max(bucket["tokens_remaining"] - delta, 0)
+            state = dict(self._public_state(bucket))
+            state.pop("meta", None)
+            states[(model, region, tenant)] = state
+        return states
+
+    def _take_tokens_batch(
+        self,
+        model: Model,
+        region: Region,
+        required_tokens: list[int],
+        tenant: Optional[Tenant] = None,
+    ) -> list[tuple[Optional[dict], Optional[float]]]:
+        if model not in self.__data or region not in self.__data[model]:
+            raise InvalidRegionError(f"Model {model} does not have region {region}")
+        buckets = [self.__data[model][region]]
+        if tenant is not None:
+            if tenant not in self.__tenants.get((model, region), {}):
+                return [(None, None)] * len(required_tokens)
+            buckets.append(self.__tenants[(model, region)][tenant])
+        return [
+            (buckets[0]["meta"], None) if granted else (None, retry_after)
+            for granted, retry_after in self._grant_tokens(buckets, required_tokens)
+        ]
@@ -1,16 +1,26 @@
 import json
+from typing import Iterable, Iterator, Optional
 
 from redis import Redis
 from redis.exceptions import ResponseError
 
-from tbc.abstract_token_bucket_carousel import Model, Region, TokenBucketCarousel
-from tbc.errors import InvalidModelError, InvalidRegionError
+from tbc.abstract_token_bucket_carousel import (
+    MICROSECONDS,
+    BucketKey,
+    BucketRecord,
+    Model,
+    Region,
+    Tenant,
+    TokenBucketCarousel,
+    batched,
+)
+from tbc.errors import InvalidModelError, InvalidRegionError, InvalidTenantError
 
 CREATE_LUA_SCRIPT = """
 if redis.call('EXISTS', KEYS[1]) == 1 then
     return redis.error_reply('Key already exists')
 else
-    redis.call('HSET', KEYS[1], 'token_allowance', ARGV[1], 'token_refresh_seconds', ARGV[2], 'meta', ARGV[3], 'tokens_remaining', ARGV[4], 'last_refresh', ARGV[5])
+    redis.call('HSET', KEYS[1], unpack(ARGV))
     return redis.status_reply('OK')
 end
 """
@@ -34,10 +44,172 @@ else
 end
 """
 
+GCRA_REPLENISH_LUA_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return redis.error_reply('Token allowance not found')
+else
+    redis.call('HSET', KEYS[1], 'tat', ARGV[1])
+    return redis.status_reply('OK')
+end
+"""
+
+CREATE_TENANT_LUA_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return redis.error_reply('Parent key does not exist')
+elseif redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.error_reply('Key already exists')
+else
+    redis.call('HSET', KEYS[2], unpack(ARGV))
+    return redis.status_reply('OK')
+end
+"""
+
+# KEYS are the region bucket followed by any nested tenant bucket, ARGV the
+# current time followed by the tokens required per request. Every level is
+# refilled if due, then each request is granted in turn only if every level
+# can cover it. Returns the region meta followed by {1} per granted request
+# or {0, seconds until it could be granted}, with -1 meaning never.
+TAKE_LUA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'token_allowance', 'token_refresh_seconds', 'tokens_remaining', 'last_refresh')
+    if not bucket[1] then
+        if i == 1 then
+            return redis.error_reply('Key does not exist')
+        end
+        return {false}
+    end
+    local level = {allowance = tonumber(bucket[1]), refresh_seconds = tonumber(bucket[2]), remaining = tonumber(bucket[3]), last_refresh = tonumber(bucket[4])}
+    if now >= level.last_refresh + level.refresh_seconds then
+        level.remaining = level.allowance
+        level.last_refresh = now
+    end
+    levels[i] = level
+end
+local results = {redis.call('HGET', KEYS[1], 'meta')}
+for j = 2, #ARGV do
+    local required = tonumber(ARGV[j])
+    local result = {1}
+    for _, level in ipairs(levels) do
+        if required > level.allowance then
+            result = {0, -1}
+            break
+        elseif level.remaining < required then
+            result = {0, level.last_refresh + level.refresh_seconds - now}
+            break
+        end
+    end
+    if result[1] == 1 then
+        for _, level in ipairs(levels) do
+            level.remaining = level.remaining - required
+        end
+    end
+    results[j] = result
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens_remaining', levels[i].remaining, 'last_refresh', levels[i].last_refresh)
+end
+return results
+"""
+
+# As TAKE_LUA_SCRIPT, but each level is a single GCRA theoretical arrival time
+# in microseconds. Times are formatted with %d as Redis would otherwise store
+# them in floating point notation, and a wait of -1 means never.
+GCRA_TAKE_LUA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'token_allowance', 'token_refresh_seconds', 'tat')
+    if not bucket[1] then
+        if i == 1 then
+            return redis.error_reply('Key does not exist')
+        end
+        return {false}
+    end
+    levels[i] = {allowance = tonumber(bucket[1]), period = tonumber(bucket[2]) * 1000000, arrival_time = tonumber(bucket[3])}
+end
+local results = {redis.call('HGET', KEYS[1], 'meta')}
+for j = 2, #ARGV do
+    local required = tonumber(ARGV[j])
+    local result = {1}
+    local arrival_times = {}
+    for i, level in ipairs(levels) do
+        if required > level.allowance then
+            result = {0, '-1'}
+            break
+        end
+        arrival_times[i] = math.max(level.arrival_time, now) + math.floor(required * level.period / level.allowance)
+        if arrival_times[i] - level.period > now then
+            result = {0, string.format('%d', arrival_times[i] - level.period - now)}
+            break
+        end
+    end
+    if result[1] == 1 then
+        for i, level in ipairs(levels) do
+            level.arrival_time = arrival_times[i]
+        end
+    end
+    results[j] = result
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tat', string.format('%d', levels[i].arrival_time))
+end
+return results
+"""
+
+
+# ARGV are the current time followed by one delta per key. Missing keys are
+# returned as nil, the others as their updated counter fields.
+CONSUME_LUA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local states = {}
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'token_allowance', 'token_refresh_seconds', 'tokens_remaining', 'last_refresh')
+    if not bucket[1] then
+        states[i] = false
+    else
+        local refresh_seconds = tonumber(bucket[2])
+        local remaining = tonumber(bucket[3])
+        local last_refresh = tonumber(bucket[4])
+        if now >= last_refresh + refresh_seconds then
+            remaining = tonumber(bucket[1])
+            last_refresh = now
+        end
+        remaining = math.max(remaining - tonumber(ARGV[i + 1]), 0)
+        redis.call('HSET', key, 'tokens_remaining', remaining, 'last_refresh', last_refresh)
+        states[i] = {bucket[1], bucket[2], remaining, last_refresh}
+    end
+end
+return states
+"""
+
+GCRA_CONSUME_LUA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local states = {}
+for i, key in ipairs(KEYS) do
+    local bucket = redis.call('HMGET', key, 'token_allowance', 'token_refresh_seconds', 'tat')
+    if not bucket[1] then
+        states[i] = false
+    else
+        local allowance = tonumber(bucket[1])
+        local period = tonumber(bucket[2]) * 1000000
+        local arrival_time = math.max(tonumber(bucket[3]), now)
+        if allowance > 0 then
+            arrival_time = arrival_time + math.floor(tonumber(ARGV[i + 1]) * period / allowance)
+        end
+        arrival_time = string.format('%d', math.min(arrival_time, now + period))
+        redis.call('HSET', key, 'tat', arrival_time)
+        states[i] = {bucket[1], bucket[2], arrival_time}
+    end
+end
+return states
+"""
+
 
 class RedisTokenBucketCarousel(TokenBucketCarousel):
-    def __init__(self, redis_client: Redis, namespace: str = "tbc"):
-        super().__init__()
+    def __init__(self, redis_client: Redis, namespace: str = "tbc", gcra: bool = False):
+        super().__init__(gcra=gcra)
         self.redis_client = redis_client
         self.namespace = namespace
 
@@ -46,6 +218,38 @@ class RedisTokenBucketCarousel(TokenBucketCarousel):
             return f"{self.namespace}:{model}"
         return f"{self.namespace}:{model}:{region}"
 
+    def _tenant_key(self, model: Model, region: Region, tenant: Tenant) -> str:
+        # Kept outside "{namespace}:*" so tenants never show up as regions
+        return f"{self.namespace}.tenant:{model}:{region}:{tenant}"
+
+    def _state(self, data: dict) -> dict:
+        state = {
+            "token_allowance": int(data["token_allowance"]),
+            "token_refresh_seconds": int(data["token_refresh_seconds"]),
+        }
+        if "tat" in data:
+            state["theoretical_arrival_time_us"] = int(data["tat"])
+        else:
+            state["tokens_remaining"] = int(data["tokens_remaining"])
+            state["last_refresh"] = int(data["last_refresh"])
+        if "meta" in data:
+            state["meta"] = json.loads(data["meta"])
+        return self._public_state(state)
+
+    def _mapping(self, state: dict) -> dict:
+        mapping = {
+            "token_allowance": state["token_allowance"],
+            "token_refresh_seconds": state["token_refresh_seconds"],
+        }
+        if self.gcra:
+            mapping["tat"] = state["theoretical_arrival_time_us"]
+        else:
+            mapping["tokens_remaining"] = state["tokens_remaining"]
+            mapping["last_refresh"] = state["last_refresh"]
+        if "meta" in state:
+            mapping["meta"] = json.dumps(state["meta"])
+        return mapping
+
     def list_models(self) -> set[Model]:
         keys = self.redis_client.keys(self._key("*"))
         return {key.split(":")[-2] for key in keys}
@@ -65,32 +269,31 @@ class RedisTokenBucketCarousel(TokenBucketCarousel):
         meta: dict,
     ):
         try:
+            mapping = self._mapping(
+                {
+                    "token_allowance": token_allowance,
+                    "token_refresh_seconds": token_refresh_seconds,
+                    "meta": meta,
+                    **self._new_state(token_allowance),
+                }
+            )
             self.redis_client.eval(
                 CREATE_LUA_SCRIPT,
                 1,
                 self._key(model, region),
-                token_allowance,
-                token_refresh_seconds,
-                json.dumps(meta),
-                token_allowance,
-                self._current_time(),
+                *[item for pair in mapping.items() for item in pair],
             )
         except ResponseError as err:
             if "Key already exists" in str(err):
                 raise ValueError(f"Model {model} already has region {region}") from err
             raise
+        self._forget_regions(model)
 
     def read_model_region(self, model: Model, region: Region):
         data = self.redis_client.hgetall(self._key(model, region))
         if not data:
             raise InvalidRegionError(f"Model {model} does not have region {region}")
-        return {
-            "token_allowance": int(data["token_allowance"]),
-            "token_refresh_seconds": int(data["token_refresh_seconds"]),
-            "meta": json.loads(data["meta"]),
-            "tokens_remaining": int(data["tokens_remaining"]),
-            "last_refresh": int(data["last_refresh"]),
-        }
+        return self._state(data)
 
     def update_model_region(
         self,
@@ -115,33 +318,197 @@ class RedisTokenBucketCarousel(TokenBucketCarousel):
                     f"Model {model} does not have region {region}"
                 ) from err
             raise
+        self._reset_region(model, region)
 
     def delete_model_region(self, model: Model, region: Region):
         key_count = self.redis_client.delete(self._key(model, region))
         if key_count == 0:
             raise InvalidRegionError(f"Model {model} does not have region {region}")
+        tenant_keys = self.redis_client.scan_iter(
+            match=self._tenant_key(model, region, "*")
+        )
+        for batch in batched(tenant_keys, 1000):
+            self.redis_client.delete(*batch)
+        self._forget_regions(model)
 
     def replenish_tokens(self, model: Model, region: Region):
         try:
+            if self.gcra:
+                self.redis_client.eval(
+                    GCRA_REPLENISH_LUA_SCRIPT,
+                    1,
+                    self._key(model, region),
+                    self._current_time_us(),
+                )
+            else:
+                self.redis_client.eval(
+                    REPLENISH_LUA_SCRIPT,
+                    1,
+                    self._key(model, region),
+                    self._current_time(),
+                )
+        except ResponseError as err:
+            if "Token allowance not found" in str(err):
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            raise
+        self._reset_region(model, region)
+
+    def create_tenant_quota(
+        self,
+        model: Model,
+        region: Region,
+        tenant: Tenant,
+        token_allowance: int,
+        token_refresh_seconds: int,
+    ):
+        try:
+            mapping = self._mapping(
+                {
+                    "token_allowance": token_allowance,
+                    "token_refresh_seconds": token_refresh_seconds,
+                    **self._new_state(token_allowance),
+                }
+            )
             self.redis_client.eval(
-                REPLENISH_LUA_SCRIPT,
-                1,
+                CREATE_TENANT_LUA_SCRIPT,
+                2,
                 self._key(model, region),
-                self._current_time(),
+                self._tenant_key(model, region, tenant),
+                *[item for pair in mapping.items() for item in pair],
             )
         except ResponseError as err:
-            if "Token allowance not found" in str(err):
+            if "Parent key does not exist" in str(err):
                 raise InvalidRegionError(
                     f"Model {model} does not have region {region}"
                 ) from err
+            if "Key already exists" in str(err):
+                raise ValueError(
+                    f"Model {model} region {region} already has tenant {tenant}"
+                ) from err
             raise
 
-    async def request_tokens(
+    def read_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        data = self.redis_client.hgetall(self._tenant_key(model, region, tenant))
+        if not data:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            )
+        return self._state(data)
+
+    def delete_tenant_quota(self, model: Model, region: Region, tenant: Tenant):
+        key_count = self.redis_client.delete(self._tenant_key(model, region, tenant))
+        if key_count == 0:
+            raise InvalidTenantError(
+                f"Model {model} region {region} does not have tenant {tenant}"
+            )
+
+    def export_buckets(self, batch_size: int = 1000) -> Iterator[BucketRecord]:
+        for pattern, is_tenant in (
+            (self._key("*", "*"), False),
+            (self._tenant_key("*", "*", "*"), True),
+        ):
+            keys = self.redis_client.scan_iter(match=pattern, count=batch_size)
+            for batch in batched(keys, batch_size):
+                pipeline = self.redis_client.pipeline(transaction=False)
+                for key in batch:
+                    pipeline.hgetall(key)
+                for key, data in zip(batch, pipeline.execute()):
+                    if not data:
+                        continue
+                    if is_tenant:
+                        model, region, tenant = key.split(":")[-3:]
+                    else:
+                        model, region = key.split(":")[-2:]
+                        tenant = None
+                    yield model, region, tenant, self._state(data)
+
+    def import_buckets(
+        self, buckets: Iterable[BucketRecord], batch_size: int = 1000
+    ) -> int:
+        count = 0
+        for batch in batched(buckets, batch_size):
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for model, region, tenant, state in batch:
+                mapping = self._mapping(self._stored_state(state))
+                if tenant is None:
+                    pipeline.hset(self._key(model, region), mapping=mapping)
+                    self._forget_regions(model)
+                else:
+                    pipeline.hset(
+                        self._tenant_key(model, region, tenant), mapping=mapping
+                    )
+            pipeline.execute()
+            count += len(batch)
+        return count
+
+    def consume_tokens(self, deltas: dict[BucketKey, int]) -> dict[BucketKey, dict]:
+        if not deltas:
+            return {}
+        bucket_keys = list(deltas)
+        keys = [
+            self._key(model, region)
+            if tenant is None
+            else self._tenant_key(model, region, tenant)
+            for model, region, tenant in bucket_keys
+        ]
+        if self.gcra:
+            fields = ("token_allowance", "token_refresh_seconds", "tat")
+            script, now = GCRA_CONSUME_LUA_SCRIPT, self._current_time_us()
+        else:
+            fields = (
+                "token_allowance",
+                "token_refresh_seconds",
+                "tokens_remaining",
+                "last_refresh",
+            )
+            script, now = CONSUME_LUA_SCRIPT, self._current_time()
+        results = self.redis_client.eval(
+            script, len(keys), *keys, now, *deltas.values()
+        )
+        return {
+            bucket_key: self._state(dict(zip(fields, result)))
+            for bucket_key, result in zip(bucket_keys, results)
+            if result
+        }
+
+    def _take_tokens_batch(
         self,
         model: Model,
-        required_tokens: int,
-        fallback_models: set[Model] = None,
-        allowed_regions: set[Region] = None,
-        preferred_region: Region = None,
-    ):
-        raise NotImplementedError
+        region: Region,
+        required_tokens: list[int],
+        tenant: Optional[Tenant] = None,
+    ) -> list[tuple[Optional[dict], Optional[float]]]:
+        keys = [self._key(model, region)]
+        if tenant is not None:
+            keys.append(self._tenant_key(model, region, tenant))
+        if self.gcra:
+            script, now = GCRA_TAKE_LUA_SCRIPT, self._current_time_us()
+        else:
+            script, now = TAKE_LUA_SCRIPT, self._current_time()
+        try:
+            meta, *results = self.redis_client.eval(
+                script, len(keys), *keys, now, *required_tokens
+            )
+        except ResponseError as err:
+            if "Key does not exist" in str(err):
+                raise InvalidRegionError(
+                    f"Model {model} does not have region {region}"
+                ) from err
+            raise
+        if meta is None:
+            return [(None, None)] * len(required_tokens)
+
+        meta = json.loads(meta)
+        taken = []
+        for result in results:
+            if result[0]:
+                taken.append((meta, None))
+            elif int(result[1]) < 0:
+                taken.append((None, None))
+            elif self.gcra:
+                taken.append((None, int(result[1]) / MICROSECONDS))
+            else:
+                taken.append((None, int(result[1])))
+        return taken
@@ -0,0 +1,131 @@
+"""Binary snapshots of carousel state and migration between backends
+
+A snapshot is the magic header followed by one record per bucket::
+
+    <flags:B> <allowance:q> <refresh_seconds:q> <remaining:q> <clock:q>
+    <model_len:H> <region_len:H> <tenant_len:H> <meta_len:I>
+    model region tenant meta
+
+Strings are UTF-8, meta is JSON and a tenant length of 0xFFFF marks a model
+region bucket (which has no tenant). clock is the last refresh time, or the
+theoretical arrival time for buckets flagged as GCRA.
+"""
+import json
+import struct
+from typing import BinaryIO, Iterable, Iterator
+
+from tbc.abstract_token_bucket_carousel import BucketRecord, TokenBucketCarousel
+
+MAGIC = b"TBC\x01"
+RECORD_HEADER = struct.Struct("<BqqqqHHHI")
+NO_TENANT = 0xFFFF
+GCRA_FLAG = 0x01
+
+
+def dump(buckets: Iterable[BucketRecord], fp: BinaryIO) -> int:
+    """Write buckets to a binary snapshot
+
+    Args:
+        buckets (Iterable[BucketRecord]): Buckets as yielded by export_buckets
+        fp (BinaryIO): File opened for binary writing
+
+    Returns:
+        int: Number of buckets written
+    """
+    fp.write(MAGIC)
+    count = 0
+    for model, region, tenant, state in buckets:
+        model_bytes = model.encode()
+        region_bytes = region.encode()
+        tenant_bytes = b"" if tenant is None else tenant.encode()
+        meta_bytes = b"" if tenant is not None else json.dumps(state["meta"]).encode()
+        is_gcra = "theoretical_arrival_time_us" in state
+        fp.write(
+            RECORD_HEADER.pack(
+                GCRA_FLAG if is_gcra else 0,
+                state["token_allowance"],
+                state["token_refresh_seconds"],
+                state["tokens_remaining"],
+                state["theoretical_arrival_time_us" if is_gcra else "last_refresh"],
+                len(model_bytes),
+                len(region_bytes),
+                NO_TENANT if tenant is None else len(tenant_bytes),
+                len(meta_bytes),
+            )
+        )
+        fp.write(model_bytes + region_bytes + tenant_bytes + meta_bytes)
+        count += 1
+    return count
+
+
+def load(fp: BinaryIO) -> Iterator[BucketRecord]:
+    """Stream buckets from a binary snapshot
+
+    Args:
+        fp (BinaryIO): File opened for binary reading
+
+    Raises:
+        ValueError: The file is not a snapshot or is truncated
+
+    Returns:
+        Iterator[BucketRecord]: Buckets ready for import_buckets
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a token bucket carousel snapshot")
+    while header := fp.read(RECORD_HEADER.size):
+        if len(header) != RECORD_HEADER.size:
+            raise ValueError("Truncated snapshot")
+        (
+            flags,
+            token_allowance,
+            token_refresh_seconds,
+            tokens_remaining,
+            clock,
+            model_len,
+            region_len,
+            tenant_len,
+            meta_len,
+        ) = RECORD_HEADER.unpack(header)
+        has_tenant = tenant_len != NO_TENANT
+        body_len = model_len + region_len + meta_len + (tenant_len if has_tenant else 0)
+        body = fp.read(body_len)
+        if len(body) != body_len:
+            raise ValueError("Truncated snapshot")
+
+        model = body[:model_len].decode()
+        body = body[model_len:]
+        region = body[:region_len].decode()
+        body = body[region_len:]
+        state = {
+            "token_allowance": token_allowance,
+            "token_refresh_seconds": token_refresh_seconds,
+            "tokens_remaining": tokens_remaining,
+        }
+        if flags & GCRA_FLAG:
+            state["theoretical_arrival_time_us"] = clock
+        else:
+            state["last_refresh"] = clock
+        if has_tenant:
+            yield model, region, body[:tenant_len].decode(), state
+        else:
+            state["meta"] = json.loads(body)
+            yield model, region, None, state
+
+
+def migrate(
+    src: TokenBucketCarousel, dst: TokenBucketCarousel, batch_size: int = 1000
+) -> int:
+    """Copy every bucket and tenant quota from one carousel to another
+
+    Buckets are streamed from the source and written to the destination in
+    batches, so the whole carousel is never held in memory.
+
+    Args:
+        src (TokenBucketCarousel): Carousel to read from
+        dst (TokenBucketCarousel): Carousel to write to
+        batch_size (int): Number of buckets read and written at once
+
+    Returns:
+        int: Number of buckets copied
+    """
+    return dst.import_buckets(src.export_buckets(batch_size), batch_size)
@@ -4,6 +4,7 @@ from unittest.mock import patch
 import pytest
 
 from tbc import (
+    CompactRedisTokenBucketCarousel,
     DynamoDBTokenBucketCarousel,
     InMemoryTokenBucketCarousel,
     RedisTokenBucketCarousel,
@@ -43,7 +44,7 @@ def in_memory_token_bucket():
 
 
 @pytest.fixture
-def dynamodb_token_bucket(dynamodb_client):
+def dynamodb_table(dynamodb_client):
     table_name = "token-table"
 
     dynamodb_client.create_table(
@@ -59,9 +60,13 @@ def dynamodb_token_bucket(dynamodb_client):
         ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
     )
     dynamodb_client.get_waiter("table_exists").wait(TableName=table_name)
+    return table_name
 
+
+@pytest.fixture
+def dynamodb_token_bucket(dynamodb_client, dynamodb_table):
     return DynamoDBTokenBucketCarousel(
-        dynamodb_client=dynamodb_client, table_name=table_name
+        dynamodb_client=dynamodb_client, table_name=dynamodb_table
     )
 
 
@@ -70,11 +75,17 @@ def redis_token_bucket(redis_client):
     return RedisTokenBucketCarousel(redis_client=redis_client)
 
 
+@pytest.fixture
+def compact_redis_token_bucket(redis_client):
+    return CompactRedisTokenBucketCarousel(redis_client=redis_client)
+
+
 @pytest.fixture(
     params=[
         "in_memory_token_bucket",
         "dynamodb_token_bucket",
         "redis_token_bucket",
+        "compact_redis_token_bucket",
     ]
 )
 def token_bucket(request):
@@ -82,6 +93,41 @@ def token_bucket(request):
     return request.getfixturevalue(request.param)
 
 
+@pytest.fixture
+def in_memory_gcra_token_bucket():
+    return InMemoryTokenBucketCarousel(gcra=True)
+
+
+@pytest.fixture
+def dynamodb_gcra_token_bucket(dynamodb_client, dynamodb_table):
+    return DynamoDBTokenBucketCarousel(
+        dynamodb_client=dynamodb_client, table_name=dynamodb_table, gcra=True
+    )
+
+
+@pytest.fixture
+def redis_gcra_token_bucket(redis_client):
+    return RedisTokenBucketCarousel(redis_client=redis_client, gcra=True)
+
+
+@pytest.fixture
+def compact_redis_gcra_token_bucket(redis_client):
+    return CompactRedisTokenBucketCarousel(redis_client=redis_client, gcra=True)
+
+
+@pytest.fixture(
+    params=[
+        "in_memory_gcra_token_bucket",
+        "dynamodb_gcra_token_bucket",
+        "redis_gcra_token_bucket",
+        "compact_redis_gcra_token_bucket",
+    ]
+)
+def gcra_token_bucket(request):
+    """Yield a GCRA mode token bucket based on the parameterized fixture."""
+    return request.getfixturevalue(request.param)
+
+
 @pytest.fixture(scope="function")
 def populated_token_bucket(token_bucket: TokenBucketCarousel):
     with patch.object(token_bucket, "_current_time", return_value=12345):
@@ -0,0 +1,140 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from tbc.abstract_token_bucket_carousel import TokenBucketCarousel
+from tbc.errors import InsufficientTokensError
+
+
+@pytest.fixture(scope="function")
+def coalescing_token_bucket(populated_token_bucket: TokenBucketCarousel):
+    populated_token_bucket.coalesce_window_seconds = 0.01
+    return populated_token_bucket
+
+
+async def test_concurrent_requests_share_one_take(
+    coalescing_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(coalescing_token_bucket, "_current_time", return_value=12345):
+        with patch.object(
+            coalescing_token_bucket,
+            "_take_tokens_batch",
+            wraps=coalescing_token_bucket._take_tokens_batch,
+        ) as take_tokens_batch:
+            metas = await asyncio.gather(
+                *(
+                    coalescing_token_bucket.request_tokens(
+                        "MODEL-2", tokens, preferred_region="us"
+                    )
+                    for tokens in (5, 6, 7)
+                )
+            )
+        state = coalescing_token_bucket.read_model_region("MODEL-2", "us")
+    assert [meta["region"] for meta in metas] == ["us", "us", "us"]
+    take_tokens_batch.assert_called_once_with("MODEL-2", "us", [5, 6, 7], None)
+    assert state["tokens_remaining"] == 2
+
+
+async def test_batch_is_granted_in_order(coalescing_token_bucket: TokenBucketCarousel):
+    with patch.object(coalescing_token_bucket, "_current_time", return_value=12345):
+        results = await asyncio.gather(
+            *(
+                coalescing_token_bucket.request_tokens(
+                    "MODEL-1", tokens, allowed_regions={"us"}
+                )
+                for tokens in (2, 4, 3)
+            ),
+            return_exceptions=True,
+        )
+        state = coalescing_token_bucket.read_model_region("MODEL-1", "us")
+    assert results[0]["region"] == "us"
+    assert isinstance(results[1], InsufficientTokensError)
+    assert results[2]["region"] == "us"
+    assert state["tokens_remaining"] == 0
+
+
+async def test_full_batch_is_taken_early(coalescing_token_bucket: TokenBucketCarousel):
+    coalescing_token_bucket.coalesce_window_seconds = 60
+    coalescing_token_bucket.coalesce_max_batch_size = 2
+    with patch.object(coalescing_token_bucket, "_current_time", return_value=12345):
+        metas = await asyncio.wait_for(
+            asyncio.gather(
+                coalescing_token_bucket.request_tokens("MODEL-2", 1),
+                coalescing_token_bucket.request_tokens("MODEL-2", 1),
+            ),
+            timeout=1,
+        )
+    assert [meta["region"] for meta in metas] == ["uk", "uk"]
+
+
+async def test_backend_error_fails_every_request(
+    coalescing_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(
+        coalescing_token_bucket,
+        "_take_tokens_batch",
+        side_effect=ConnectionError("backend unavailable"),
+    ) as take_tokens_batch:
+        results = await asyncio.gather(
+            coalescing_token_bucket.request_tokens(
+                "MODEL-1", 1, allowed_regions={"us"}
+            ),
+            coalescing_token_bucket.request_tokens(
+                "MODEL-1", 1, allowed_regions={"us"}
+            ),
+            return_exceptions=True,
+        )
+    take_tokens_batch.assert_called_once()
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+async def test_failed_batch_counts_as_one_failure(
+    coalescing_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(
+        coalescing_token_bucket,
+        "_take_tokens_batch",
+        side_effect=ConnectionError("backend unavailable"),
+    ):
+        await asyncio.gather(
+            *(
+                coalescing_token_bucket.request_tokens(
+                    "MODEL-1", 1, allowed_regions={"us"}
+                )
+                for _ in range(3)
+            ),
+            return_exceptions=True,
+        )
+    region_state = coalescing_token_bucket._models["MODEL-1"]["us"]
+    assert region_state["failures"] == 1
+    assert "open_until" not in region_state
+
+
+async def test_coalescing_window_is_not_a_slow_take(
+    coalescing_token_bucket: TokenBucketCarousel,
+):
+    coalescing_token_bucket.coalesce_window_seconds = 0.2
+    coalescing_token_bucket.slow_take_seconds = 0.1
+    coalescing_token_bucket.circuit_breaker_failures = 1
+    with patch.object(coalescing_token_bucket, "_current_time", return_value=12345):
+        for _ in range(2):
+            meta = await coalescing_token_bucket.request_tokens(
+                "MODEL-2", 1, preferred_region="uk"
+            )
+            assert meta["region"] == "uk"
+
+
+async def test_cancelled_request_takes_no_tokens(
+    coalescing_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(coalescing_token_bucket, "_current_time", return_value=12345):
+        cancelled = asyncio.ensure_future(
+            coalescing_token_bucket.request_tokens("MODEL-1", 4, allowed_regions={"us"})
+        )
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        meta = await coalescing_token_bucket.request_tokens(
+            "MODEL-1", 5, allowed_regions={"us"}
+        )
+    assert meta["region"] == "us"
@@ -0,0 +1,176 @@
+from unittest.mock import patch
+
+import pytest
+
+from tbc import CompactRedisTokenBucketCarousel
+from tbc.compact_redis_token_bucket_carousel import VERSION_FIELD
+from tbc.errors import (
+    InsufficientTokensError,
+    InvalidTenantError,
+    PartialConsumptionError,
+)
+
+
+@pytest.fixture(scope="function")
+def compact_token_bucket(redis_client):
+    token_bucket = CompactRedisTokenBucketCarousel(redis_client=redis_client)
+    token_bucket.create_model_region("MODEL-1", "uk", 10, 60, {"region": "uk"})
+    token_bucket.create_model_region("MODEL-1", "us", 10, 60, {"region": "us"})
+    token_bucket.create_tenant_quota("MODEL-1", "uk", "TENANT-1", 5, 60)
+    return token_bucket
+
+
+def test_model_is_stored_in_two_hashes(compact_token_bucket, redis_client):
+    assert set(redis_client.keys()) == {
+        "tbc.compact:{MODEL-1}:counters",
+        "tbc.compact:{MODEL-1}:config",
+    }
+    assert set(redis_client.hkeys("tbc.compact:{MODEL-1}:counters")) == {
+        "uk",
+        "us",
+        "uk#TENANT-1",
+    }
+    assert set(redis_client.hkeys("tbc.compact:{MODEL-1}:config")) == {
+        "uk",
+        "us",
+        VERSION_FIELD,
+    }
+
+
+async def test_meta_is_cached_between_takes(compact_token_bucket, redis_client):
+    with patch.object(redis_client, "hget", wraps=redis_client.hget) as hget:
+        first = await compact_token_bucket.request_tokens(
+            "MODEL-1", 1, preferred_region="uk"
+        )
+        second = await compact_token_bucket.request_tokens(
+            "MODEL-1", 1, preferred_region="uk"
+        )
+    assert first == second == {"region": "uk"}
+    hget.assert_called_once_with("tbc.compact:{MODEL-1}:config", "uk")
+
+
+async def test_meta_update_by_another_client_is_seen(
+    compact_token_bucket, redis_client
+):
+    await compact_token_bucket.request_tokens("MODEL-1", 1, preferred_region="uk")
+    other = CompactRedisTokenBucketCarousel(redis_client=redis_client)
+    other.update_model_region("MODEL-1", "uk", 10, 60, {"region": "uk", "v": 2})
+
+    meta = await compact_token_bucket.request_tokens(
+        "MODEL-1", 1, preferred_region="uk"
+    )
+    assert meta == {"region": "uk", "v": 2}
+
+
+async def test_recreated_region_does_not_reuse_cached_meta(
+    compact_token_bucket, redis_client
+):
+    await compact_token_bucket.request_tokens("MODEL-1", 1, preferred_region="uk")
+    other = CompactRedisTokenBucketCarousel(redis_client=redis_client)
+    other.delete_model_region("MODEL-1", "uk")
+    other.delete_model_region("MODEL-1", "us")
+    other.create_model_region("MODEL-1", "uk", 10, 60, {"region": "uk", "v": 2})
+
+    meta = await compact_token_bucket.request_tokens(
+        "MODEL-1", 1, preferred_region="uk"
+    )
+    assert meta == {"region": "uk", "v": 2}
+
+
+def test_deleting_region_deletes_its_tenant_quotas(compact_token_bucket):
+    compact_token_bucket.delete_model_region("MODEL-1", "uk")
+    compact_token_bucket.create_model_region("MODEL-1", "uk", 10, 60, {})
+
+    with pytest.raises(InvalidTenantError):
+        compact_token_bucket.read_tenant_quota("MODEL-1", "uk", "TENANT-1")
+
+
+async def test_drained_model_is_one_round_trip(compact_token_bucket, redis_client):
+    await compact_token_bucket.request_tokens("MODEL-1", 10, preferred_region="uk")
+    with patch.object(redis_client, "eval", wraps=redis_client.eval) as eval_:
+        meta = await compact_token_bucket.request_tokens(
+            "MODEL-1", 10, preferred_region="uk"
+        )
+    assert meta == {"region": "us"}
+    assert eval_.call_count == 1
+
+    with patch.object(redis_client, "eval", wraps=redis_client.eval) as eval_:
+        with pytest.raises(InsufficientTokensError) as exc_info:
+            await compact_token_bucket.request_tokens("MODEL-1", 1)
+    assert eval_.call_count == 1
+    assert 0 < exc_info.value.retry_after <= 60
+
+
+async def test_backend_error_feeds_every_region_circuit_breaker(
+    compact_token_bucket, redis_client
+):
+    compact_token_bucket.circuit_breaker_failures = 1
+    with patch.object(redis_client, "eval", side_effect=ConnectionError("down")):
+        with pytest.raises(ConnectionError):
+            await compact_token_bucket.request_tokens("MODEL-1", 1)
+    with patch.object(redis_client, "eval") as eval_:
+        with pytest.raises(InsufficientTokensError):
+            await compact_token_bucket.request_tokens("MODEL-1", 1)
+    eval_.assert_not_called()
+
+
+async def test_slow_take_feeds_every_region_circuit_breaker(
+    compact_token_bucket, redis_client
+):
+    compact_token_bucket.slow_take_seconds = 0.5
+    compact_token_bucket.circuit_breaker_failures = 1
+    with patch("time.perf_counter", side_effect=[0, 1]):
+        meta = await compact_token_bucket.request_tokens(
+            "MODEL-1", 1, preferred_region="uk"
+        )
+    assert meta == {"region": "uk"}
+    with patch.object(redis_client, "eval") as eval_:
+        with pytest.raises(InsufficientTokensError):
+            await compact_token_bucket.request_tokens("MODEL-1", 1)
+    eval_.assert_not_called()
+
+
+async def test_skipped_regions_are_left_out_of_the_script_call(
+    compact_token_bucket, redis_client
+):
+    compact_token_bucket.circuit_breaker_failures = 1
+    compact_token_bucket._get_regions("MODEL-1")
+    compact_token_bucket._record_failure(
+        compact_token_bucket._models["MODEL-1"]["uk"], compact_token_bucket._clock()
+    )
+    with patch.object(redis_client, "eval", wraps=redis_client.eval) as eval_:
+        meta = await compact_token_bucket.request_tokens(
+            "MODEL-1", 1, preferred_region="uk"
+        )
+    assert meta == {"region": "us"}
+    assert eval_.call_args.args[-1:] == ("us",)
+
+
+@pytest.mark.parametrize("gcra", [False, True])
+async def test_region_deleted_by_another_client_is_passed_over(redis_client, gcra):
+    token_bucket = CompactRedisTokenBucketCarousel(redis_client=redis_client, gcra=gcra)
+    token_bucket.create_model_region("MODEL-1", "uk", 10, 60, {"region": "uk"})
+    token_bucket.create_model_region("MODEL-1", "us", 10, 60, {"region": "us"})
+    await token_bucket.request_tokens("MODEL-1", 1, preferred_region="uk")
+    other = CompactRedisTokenBucketCarousel(redis_client=redis_client, gcra=gcra)
+    other.delete_model_region("MODEL-1", "uk")
+
+    with patch.object(redis_client, "eval", wraps=redis_client.eval) as eval_:
+        meta = await token_bucket.request_tokens("MODEL-1", 1, preferred_region="uk")
+    assert meta == {"region": "us"}
+    assert eval_.call_count == 1
+    assert token_bucket._get_regions("MODEL-1") == {"us"}
+
+
+def test_failed_model_reports_settled_buckets(compact_token_bucket, redis_client):
+    compact_token_bucket.create_model_region("MODEL-2", "uk", 10, 60, {})
+    redis_client.hset("tbc.compact:{MODEL-2}:counters", "uk", "corrupt")
+
+    with pytest.raises(PartialConsumptionError) as exc_info:
+        compact_token_bucket.consume_tokens(
+            {("MODEL-1", "uk", None): 1, ("MODEL-2", "uk", None): 1}
+        )
+    assert exc_info.value.settled == {("MODEL-1", "uk", None)}
+    assert (
+        compact_token_bucket.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 9
+    )
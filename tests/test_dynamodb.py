@@ -0,0 +1,129 @@
+from unittest.mock import patch
+
+import pytest
+
+from tbc import DynamoDBTokenBucketCarousel
+from tbc.errors import PartialConsumptionError
+
+
+@pytest.fixture(scope="function")
+def dynamodb_carousel(dynamodb_token_bucket: DynamoDBTokenBucketCarousel):
+    with patch.object(dynamodb_token_bucket, "_current_time", return_value=12345):
+        dynamodb_token_bucket.create_model_region("MODEL-1", "uk", 10, 60, {"a": 1})
+        dynamodb_token_bucket.create_tenant_quota("MODEL-1", "uk", "acme", 5, 60)
+    return dynamodb_token_bucket
+
+
+def test_take_is_a_single_update(dynamodb_carousel, dynamodb_client):
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12346):
+        with patch.object(
+            dynamodb_client, "update_item", wraps=dynamodb_client.update_item
+        ) as update_item, patch.object(dynamodb_client, "get_item") as get_item:
+            meta, _ = dynamodb_carousel._take_tokens("MODEL-1", "uk", 3)
+    assert meta == {"a": 1}
+    update_item.assert_called_once()
+    get_item.assert_not_called()
+    assert dynamodb_carousel.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 7
+
+
+def test_tenant_take_is_a_single_transaction(dynamodb_carousel, dynamodb_client):
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12346):
+        dynamodb_carousel._take_tokens("MODEL-1", "uk", 1, "acme")
+        with patch.object(
+            dynamodb_client,
+            "transact_write_items",
+            wraps=dynamodb_client.transact_write_items,
+        ) as transact_write_items, patch.object(
+            dynamodb_client, "transact_get_items"
+        ) as transact_get_items:
+            meta, _ = dynamodb_carousel._take_tokens("MODEL-1", "uk", 1, "acme")
+    assert meta == {"a": 1}
+    transact_write_items.assert_called_once()
+    transact_get_items.assert_not_called()
+    quota = dynamodb_carousel.read_tenant_quota("MODEL-1", "uk", "acme")
+    assert quota["tokens_remaining"] == 3
+
+
+def test_tenant_take_sees_updated_meta(dynamodb_carousel, dynamodb_client):
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12346):
+        dynamodb_carousel._take_tokens("MODEL-1", "uk", 1, "acme")
+        other = DynamoDBTokenBucketCarousel(
+            dynamodb_client=dynamodb_client, table_name=dynamodb_carousel.table_name
+        )
+        other.update_model_region("MODEL-1", "uk", 10, 60, {"a": 2})
+        meta, _ = dynamodb_carousel._take_tokens("MODEL-1", "uk", 1, "acme")
+    assert meta == {"a": 2}
+
+
+def test_refill_is_taken_after_reading(dynamodb_carousel):
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12346):
+        dynamodb_carousel._take_tokens("MODEL-1", "uk", 10)
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12405):
+        meta, _ = dynamodb_carousel._take_tokens("MODEL-1", "uk", 4)
+        region = dynamodb_carousel.read_model_region("MODEL-1", "uk")
+    assert meta == {"a": 1}
+    assert region["tokens_remaining"] == 6
+    assert region["last_refresh"] == 12405
+
+
+def test_contended_take_raises(dynamodb_carousel, dynamodb_client):
+    conflict = dynamodb_client.exceptions.ConditionalCheckFailedException(
+        {"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem"
+    )
+    with patch.object(dynamodb_client, "update_item", side_effect=conflict):
+        with pytest.raises(RuntimeError, match="concurrent updates"):
+            dynamodb_carousel._take_tokens("MODEL-1", "uk", 1)
+
+
+def test_idle_buckets_are_not_written(dynamodb_carousel, dynamodb_client):
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12405):
+        with patch.object(
+            dynamodb_client,
+            "transact_write_items",
+            wraps=dynamodb_client.transact_write_items,
+        ) as transact_write_items:
+            states = dynamodb_carousel.consume_tokens(
+                {("MODEL-1", "uk", None): 0, ("MODEL-1", "uk", "acme"): 2}
+            )
+    assert states[("MODEL-1", "uk", None)]["tokens_remaining"] == 10
+    assert states[("MODEL-1", "uk", "acme")]["tokens_remaining"] == 3
+    (updates,) = transact_write_items.call_args.kwargs.values()
+    assert [update["Update"]["Key"]["Region"]["S"] for update in updates] == ["uk#acme"]
+
+
+def test_failed_transaction_reports_settled_buckets(dynamodb_carousel, dynamodb_client):
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12345):
+        for tenant in range(150):
+            dynamodb_carousel.create_tenant_quota("MODEL-1", "uk", str(tenant), 5, 60)
+    deltas = {("MODEL-1", "uk", str(tenant)): 1 for tenant in range(150)}
+    transact_write_items = dynamodb_client.transact_write_items
+    calls = []
+
+    def fail_second_transaction(**kwargs):
+        calls.append(kwargs)
+        if len(calls) > 1:
+            raise ConnectionError("down")
+        return transact_write_items(**kwargs)
+
+    with patch.object(dynamodb_carousel, "_current_time", return_value=12346):
+        with patch.object(
+            dynamodb_client,
+            "transact_write_items",
+            side_effect=fail_second_transaction,
+        ):
+            with pytest.raises(PartialConsumptionError) as exc_info:
+                dynamodb_carousel.consume_tokens(deltas)
+    assert exc_info.value.settled == set(list(deltas)[:100])
+    assert isinstance(exc_info.value.__cause__, ConnectionError)
+
+
+def test_list_model_regions_reads_every_page(dynamodb_carousel, dynamodb_client):
+    dynamodb_carousel.create_model_region("MODEL-1", "us", 10, 60, {})
+    query = dynamodb_client.query
+
+    def one_item_per_page(**kwargs):
+        return query(**kwargs, Limit=1)
+
+    with patch.object(dynamodb_client, "query", side_effect=one_item_per_page):
+        regions = dynamodb_carousel.list_model_regions("MODEL-1")
+    assert regions == {"uk", "us"}
@@ -0,0 +1,125 @@
+from unittest.mock import patch
+
+import pytest
+
+from tbc import InMemoryTokenBucketCarousel
+from tbc.abstract_token_bucket_carousel import TokenBucketCarousel
+from tbc.errors import InsufficientTokensError
+from tbc.snapshot import migrate
+
+NOW_US = 12345 * 1_000_000
+
+
+@pytest.fixture(scope="function")
+def populated_gcra_token_bucket(gcra_token_bucket: TokenBucketCarousel):
+    with patch.object(gcra_token_bucket, "_current_time_us", return_value=NOW_US):
+        gcra_token_bucket.create_model_region(
+            "MODEL-1", "uk", 5, 1, {"model": "MODEL-1", "region": "uk"}
+        )
+    return gcra_token_bucket
+
+
+def test_read_model_region(populated_gcra_token_bucket: TokenBucketCarousel):
+    with patch.object(
+        populated_gcra_token_bucket, "_current_time_us", return_value=NOW_US
+    ):
+        region = populated_gcra_token_bucket.read_model_region("MODEL-1", "uk")
+    assert region == {
+        "token_allowance": 5,
+        "token_refresh_seconds": 1,
+        "meta": {"model": "MODEL-1", "region": "uk"},
+        "tokens_remaining": 5,
+        "theoretical_arrival_time_us": NOW_US,
+    }, "Region not read"
+
+
+async def test_request_tokens_burst_then_retry_after(
+    populated_gcra_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(
+        populated_gcra_token_bucket, "_current_time_us", return_value=NOW_US
+    ):
+        for _ in range(5):
+            await populated_gcra_token_bucket.request_tokens("MODEL-1", 1)
+        assert (
+            populated_gcra_token_bucket.read_model_region("MODEL-1", "uk")[
+                "tokens_remaining"
+            ]
+            == 0
+        )
+        with pytest.raises(InsufficientTokensError) as exc_info:
+            await populated_gcra_token_bucket.request_tokens("MODEL-1", 2)
+    assert exc_info.value.retry_after == pytest.approx(0.4)
+
+
+async def test_request_tokens_after_emission_interval(
+    populated_gcra_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(
+        populated_gcra_token_bucket, "_current_time_us", return_value=NOW_US
+    ):
+        await populated_gcra_token_bucket.request_tokens("MODEL-1", 5)
+    with patch.object(
+        populated_gcra_token_bucket, "_current_time_us", return_value=NOW_US + 200_000
+    ):
+        meta = await populated_gcra_token_bucket.request_tokens("MODEL-1", 1)
+        with pytest.raises(InsufficientTokensError):
+            await populated_gcra_token_bucket.request_tokens("MODEL-1", 1)
+    assert meta["region"] == "uk"
+
+
+async def test_request_more_than_allowance_never_conforms(
+    populated_gcra_token_bucket: TokenBucketCarousel,
+):
+    with pytest.raises(InsufficientTokensError) as exc_info:
+        await populated_gcra_token_bucket.request_tokens("MODEL-1", 6)
+    assert exc_info.value.retry_after is None
+
+
+async def test_replenish_tokens(populated_gcra_token_bucket: TokenBucketCarousel):
+    with patch.object(
+        populated_gcra_token_bucket, "_current_time_us", return_value=NOW_US
+    ):
+        await populated_gcra_token_bucket.request_tokens("MODEL-1", 5)
+        populated_gcra_token_bucket.replenish_tokens("MODEL-1", "uk")
+        region = populated_gcra_token_bucket.read_model_region("MODEL-1", "uk")
+    assert region["tokens_remaining"] == 5
+
+
+async def test_tenant_quota(populated_gcra_token_bucket: TokenBucketCarousel):
+    with patch.object(
+        populated_gcra_token_bucket, "_current_time_us", return_value=NOW_US
+    ):
+        populated_gcra_token_bucket.create_tenant_quota("MODEL-1", "uk", "acme", 2, 1)
+        await populated_gcra_token_bucket.request_tokens("MODEL-1", 2, tenant="acme")
+        with pytest.raises(InsufficientTokensError) as exc_info:
+            await populated_gcra_token_bucket.request_tokens(
+                "MODEL-1", 1, tenant="acme"
+            )
+        quota = populated_gcra_token_bucket.read_tenant_quota("MODEL-1", "uk", "acme")
+        region = populated_gcra_token_bucket.read_model_region("MODEL-1", "uk")
+    assert exc_info.value.retry_after == pytest.approx(0.5)
+    assert quota["tokens_remaining"] == 0
+    assert region["tokens_remaining"] == 3
+
+
+def test_migrate_from_token_bucket(gcra_token_bucket: TokenBucketCarousel):
+    src = InMemoryTokenBucketCarousel()
+    src.create_model_region("MODEL-1", "uk", 5, 1, {"model": "MODEL-1"})
+    src._take_tokens("MODEL-1", "uk", 3)
+    with patch.object(gcra_token_bucket, "_current_time_us", return_value=NOW_US):
+        migrate(src, gcra_token_bucket)
+        region = gcra_token_bucket.read_model_region("MODEL-1", "uk")
+    assert region["tokens_remaining"] == 2
+
+
+def test_consume_tokens(populated_gcra_token_bucket: TokenBucketCarousel):
+    with patch.object(
+        populated_gcra_token_bucket, "_current_time_us", return_value=NOW_US
+    ):
+        states = populated_gcra_token_bucket.consume_tokens(
+            {("MODEL-1", "uk", None): 2}
+        )
+        region = populated_gcra_token_bucket.read_model_region("MODEL-1", "uk")
+    assert states[("MODEL-1", "uk", None)]["tokens_remaining"] == 3
+    assert region["theoretical_arrival_time_us"] == NOW_US + 400_000
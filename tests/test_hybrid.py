@@ -0,0 +1,192 @@
+import asyncio
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from tbc import HybridTokenBucketCarousel
+from tbc.abstract_token_bucket_carousel import TokenBucketCarousel
+from tbc.errors import InsufficientTokensError, PartialConsumptionError
+
+
+@pytest.fixture(scope="function")
+def backend(token_bucket: TokenBucketCarousel):
+    token_bucket.create_model_region(
+        "MODEL-1", "uk", 10, 3600, {"model": "MODEL-1", "region": "uk"}
+    )
+    token_bucket.create_model_region(
+        "MODEL-1", "us", 20, 3600, {"model": "MODEL-1", "region": "us"}
+    )
+    token_bucket.create_tenant_quota("MODEL-1", "uk", "acme", 4, 3600)
+    return token_bucket
+
+
+@pytest.fixture(scope="function")
+def hybrid_token_bucket(backend: TokenBucketCarousel):
+    hybrid = HybridTokenBucketCarousel(backend, max_staleness_seconds=3600)
+    hybrid.load()
+    return hybrid
+
+
+async def test_request_tokens_is_served_locally(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    with patch.object(backend, "_take_tokens") as take_tokens, patch.object(
+        backend, "consume_tokens"
+    ) as consume_tokens:
+        meta = await hybrid_token_bucket.request_tokens(
+            "MODEL-1", 3, preferred_region="uk"
+        )
+    assert meta == {"model": "MODEL-1", "region": "uk"}
+    take_tokens.assert_not_called()
+    consume_tokens.assert_not_called()
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 10
+
+
+async def test_sync_settles_consumption(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    await hybrid_token_bucket.request_tokens("MODEL-1", 3, preferred_region="uk")
+    await hybrid_token_bucket.request_tokens(
+        "MODEL-1", 1, preferred_region="uk", tenant="acme"
+    )
+    hybrid_token_bucket.sync()
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 6
+    assert backend.read_tenant_quota("MODEL-1", "uk", "acme")["tokens_remaining"] == 3
+
+
+async def test_sync_pulls_global_remaining(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    backend.consume_tokens({("MODEL-1", "uk", None): 8})
+    await hybrid_token_bucket.request_tokens("MODEL-1", 1, preferred_region="uk")
+    hybrid_token_bucket.sync()
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 1
+    with pytest.raises(InsufficientTokensError):
+        await hybrid_token_bucket.request_tokens("MODEL-1", 2, allowed_regions={"uk"})
+
+
+async def test_node_share_bounds_local_allowance(backend: TokenBucketCarousel):
+    hybrid = HybridTokenBucketCarousel(
+        backend, node_share=0.5, max_staleness_seconds=3600
+    )
+    hybrid.load()
+    await hybrid.request_tokens("MODEL-1", 5, allowed_regions={"uk"})
+    with pytest.raises(InsufficientTokensError):
+        await hybrid.request_tokens("MODEL-1", 1, allowed_regions={"uk"})
+
+
+async def test_node_share_leaves_small_buckets_usable(backend: TokenBucketCarousel):
+    backend.create_model_region("MODEL-2", "uk", 1, 3600, {"model": "MODEL-2"})
+    hybrid = HybridTokenBucketCarousel(
+        backend, node_share=0.5, max_staleness_seconds=3600
+    )
+    hybrid.load()
+    meta = await hybrid.request_tokens("MODEL-2", 1)
+    assert meta == {"model": "MODEL-2"}
+
+
+async def test_stale_mirror_syncs_before_serving(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    await hybrid_token_bucket.request_tokens("MODEL-1", 3, preferred_region="uk")
+    with patch.object(hybrid_token_bucket, "_monotonic_time", return_value=1e12):
+        await hybrid_token_bucket.request_tokens("MODEL-1", 1, preferred_region="uk")
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 7
+
+
+async def test_failed_sync_keeps_consumption(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    await hybrid_token_bucket.request_tokens("MODEL-1", 3, preferred_region="uk")
+    with patch.object(backend, "consume_tokens", side_effect=ConnectionError):
+        with pytest.raises(ConnectionError):
+            hybrid_token_bucket.sync()
+    hybrid_token_bucket.sync()
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 7
+
+
+async def test_partly_failed_sync_keeps_only_unsettled_consumption(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    await hybrid_token_bucket.request_tokens("MODEL-1", 3, allowed_regions={"uk"})
+    await hybrid_token_bucket.request_tokens("MODEL-1", 2, allowed_regions={"us"})
+    consume_tokens = backend.consume_tokens
+
+    def consume_uk_only(deltas):
+        settled = {key for key in deltas if key[1] == "uk"}
+        consume_tokens({key: deltas[key] for key in settled})
+        raise PartialConsumptionError("us failed", settled)
+
+    with patch.object(backend, "consume_tokens", side_effect=consume_uk_only):
+        with pytest.raises(PartialConsumptionError):
+            hybrid_token_bucket.sync()
+    hybrid_token_bucket.sync()
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 7
+    assert backend.read_model_region("MODEL-1", "us")["tokens_remaining"] == 18
+
+
+async def test_failed_inline_sync_backs_off(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    with patch.object(
+        backend, "consume_tokens", side_effect=ConnectionError
+    ) as consume_tokens:
+        with patch.object(hybrid_token_bucket, "_monotonic_time", return_value=1e12):
+            # Both regions are tried, but the stale mirror is synced once
+            with pytest.raises(InsufficientTokensError):
+                await hybrid_token_bucket.request_tokens("MODEL-1", 25)
+            meta = await hybrid_token_bucket.request_tokens("MODEL-1", 1)
+        assert meta["model"] == "MODEL-1"
+        assert consume_tokens.call_count == 1
+
+        with patch.object(
+            hybrid_token_bucket, "_monotonic_time", return_value=1e12 + 3601
+        ):
+            await hybrid_token_bucket.request_tokens("MODEL-1", 1)
+        assert consume_tokens.call_count == 2
+
+
+async def test_unknown_tenant_is_denied(
+    hybrid_token_bucket: HybridTokenBucketCarousel,
+):
+    with pytest.raises(InsufficientTokensError):
+        await hybrid_token_bucket.request_tokens("MODEL-1", 1, tenant="other")
+
+
+async def test_sync_forgets_deleted_bucket(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    await hybrid_token_bucket.request_tokens("MODEL-1", 1, preferred_region="us")
+    backend.delete_model_region("MODEL-1", "us")
+    hybrid_token_bucket.sync()
+    meta = await hybrid_token_bucket.request_tokens("MODEL-1", 1, preferred_region="us")
+    assert meta["region"] == "uk"
+
+
+async def test_run_serves_requests_while_backend_syncs(
+    hybrid_token_bucket: HybridTokenBucketCarousel, backend: TokenBucketCarousel
+):
+    await hybrid_token_bucket.request_tokens("MODEL-1", 3, preferred_region="uk")
+    consume_tokens = backend.consume_tokens
+    started, release = threading.Event(), threading.Event()
+
+    def blocked_consume(deltas):
+        started.set()
+        release.wait(5)
+        return consume_tokens(deltas)
+
+    with patch.object(backend, "consume_tokens", side_effect=blocked_consume):
+        run = asyncio.ensure_future(hybrid_token_bucket.run(0.01))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        # The loop is free while the backend call is in flight
+        await hybrid_token_bucket.request_tokens("MODEL-1", 2, preferred_region="uk")
+        run.cancel()
+        release.set()
+        while backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 10:
+            await asyncio.sleep(0.01)
+
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 7
+    hybrid_token_bucket.sync()
+    assert backend.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 5
@@ -0,0 +1,174 @@
+from unittest.mock import patch
+
+import pytest
+
+from tbc import CompactRedisTokenBucketCarousel
+from tbc.abstract_token_bucket_carousel import TokenBucketCarousel
+from tbc.errors import InsufficientTokensError
+
+
+@pytest.fixture(scope="function")
+def drained_token_bucket(populated_token_bucket: TokenBucketCarousel):
+    """MODEL-1 with uk drained and one of the five us tokens taken"""
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        populated_token_bucket._take_tokens("MODEL-1", "uk", 1)
+        populated_token_bucket._take_tokens("MODEL-1", "us", 1)
+    return populated_token_bucket
+
+
+def require_per_region_takes(token_bucket: TokenBucketCarousel):
+    if isinstance(token_bucket, CompactRedisTokenBucketCarousel):
+        pytest.skip("Takes every candidate region in one backend call")
+
+
+def probed_regions(take_tokens) -> list:
+    return [call.args[1] for call in take_tokens.call_args_list]
+
+
+async def test_exhausted_region_is_skipped(drained_token_bucket: TokenBucketCarousel):
+    with patch.object(drained_token_bucket, "_current_time", return_value=12345):
+        meta = await drained_token_bucket.request_tokens(
+            "MODEL-1", 1, preferred_region="uk"
+        )
+        with patch.object(
+            drained_token_bucket,
+            "_take_first_region",
+            wraps=drained_token_bucket._take_first_region,
+        ) as take_first_region:
+            meta = await drained_token_bucket.request_tokens(
+                "MODEL-1", 1, preferred_region="uk"
+            )
+    assert meta["region"] == "us"
+    (call,) = take_first_region.call_args_list
+    assert list(call.args[1]) == ["us"]
+
+
+async def test_all_exhausted_reports_retry_after_without_probing(
+    drained_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(drained_token_bucket, "_current_time", return_value=12345):
+        drained_token_bucket._take_tokens("MODEL-1", "us", 4)
+        with pytest.raises(InsufficientTokensError):
+            await drained_token_bucket.request_tokens("MODEL-1", 1)
+        with patch.object(drained_token_bucket, "_take_tokens") as take_tokens:
+            with pytest.raises(InsufficientTokensError) as exc_info:
+                await drained_token_bucket.request_tokens("MODEL-1", 1)
+    take_tokens.assert_not_called()
+    assert exc_info.value.retry_after == 1
+
+
+async def test_smaller_request_still_probes(drained_token_bucket: TokenBucketCarousel):
+    with patch.object(drained_token_bucket, "_current_time", return_value=12345):
+        with pytest.raises(InsufficientTokensError):
+            await drained_token_bucket.request_tokens("MODEL-1", 5)
+        meta = await drained_token_bucket.request_tokens("MODEL-1", 4)
+    assert meta["region"] == "us"
+
+
+async def test_exhausted_region_is_probed_after_refresh(
+    drained_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(drained_token_bucket, "_current_time", return_value=12345):
+        with pytest.raises(InsufficientTokensError):
+            await drained_token_bucket.request_tokens(
+                "MODEL-1", 1, allowed_regions={"uk"}
+            )
+    with patch.object(drained_token_bucket, "_current_time", return_value=12346):
+        meta = await drained_token_bucket.request_tokens(
+            "MODEL-1", 1, allowed_regions={"uk"}
+        )
+    assert meta["region"] == "uk"
+
+
+async def test_replenish_tokens_clears_exhaustion(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        populated_token_bucket.create_model_region(
+            "MODEL-3", "uk", 1, 60, {"model": "MODEL-3", "region": "uk"}
+        )
+        await populated_token_bucket.request_tokens("MODEL-3", 1)
+    with patch.object(populated_token_bucket, "_current_time", return_value=12346):
+        with pytest.raises(InsufficientTokensError):
+            await populated_token_bucket.request_tokens("MODEL-3", 1)
+        populated_token_bucket.replenish_tokens("MODEL-3", "uk")
+        meta = await populated_token_bucket.request_tokens("MODEL-3", 1)
+    assert meta["region"] == "uk"
+
+
+async def test_exhausted_tenant_does_not_skip_region(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        populated_token_bucket.create_tenant_quota("MODEL-2", "uk", "acme", 1, 1)
+        with pytest.raises(InsufficientTokensError):
+            await populated_token_bucket.request_tokens(
+                "MODEL-2", 2, allowed_regions={"uk"}, tenant="acme"
+            )
+        meta = await populated_token_bucket.request_tokens(
+            "MODEL-2", 2, allowed_regions={"uk"}
+        )
+    assert meta["region"] == "uk"
+
+
+async def test_failing_region_opens_circuit_breaker(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    require_per_region_takes(populated_token_bucket)
+    take_tokens = populated_token_bucket._take_tokens
+
+    def failing_uk(model, region, required_tokens, tenant=None):
+        if region == "uk":
+            raise ConnectionError("uk is down")
+        return take_tokens(model, region, required_tokens, tenant)
+
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        with patch.object(
+            populated_token_bucket, "_take_tokens", side_effect=failing_uk
+        ) as mock:
+            for _ in range(3):
+                await populated_token_bucket.request_tokens(
+                    "MODEL-2", 1, preferred_region="uk"
+                )
+            mock.reset_mock()
+            meta = await populated_token_bucket.request_tokens(
+                "MODEL-2", 1, preferred_region="uk"
+            )
+    assert meta["region"] == "us"
+    assert probed_regions(mock) == ["us"]
+
+    with patch.object(populated_token_bucket, "_current_time", return_value=12351):
+        meta = await populated_token_bucket.request_tokens(
+            "MODEL-2", 1, preferred_region="uk"
+        )
+    assert meta["region"] == "uk"
+
+
+async def test_backend_error_is_raised_when_no_region_succeeds(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    require_per_region_takes(populated_token_bucket)
+    with patch.object(
+        populated_token_bucket,
+        "_take_tokens",
+        side_effect=ConnectionError("backend is down"),
+    ):
+        with pytest.raises(ConnectionError, match="backend is down"):
+            await populated_token_bucket.request_tokens("MODEL-1", 1)
+
+
+async def test_slow_region_opens_circuit_breaker(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    require_per_region_takes(populated_token_bucket)
+    populated_token_bucket.slow_take_seconds = 0.5
+    populated_token_bucket.circuit_breaker_failures = 1
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        with patch("time.perf_counter", side_effect=[0, 1, 0, 0]):
+            await populated_token_bucket.request_tokens(
+                "MODEL-2", 1, preferred_region="uk"
+            )
+            meta = await populated_token_bucket.request_tokens(
+                "MODEL-2", 1, preferred_region="uk"
+            )
+    assert meta["region"] == "us"
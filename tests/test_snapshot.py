@@ -0,0 +1,105 @@
+import io
+from unittest.mock import patch
+
+import pytest
+
+from tbc import InMemoryTokenBucketCarousel
+from tbc.abstract_token_bucket_carousel import TokenBucketCarousel
+from tbc.snapshot import dump, load, migrate
+
+
+@pytest.fixture(scope="function")
+def drained_token_bucket(populated_token_bucket: TokenBucketCarousel):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        populated_token_bucket.create_tenant_quota("MODEL-2", "uk", "acme", 3, 1)
+        populated_token_bucket._take_tokens("MODEL-2", "uk", 2, "acme")
+    return populated_token_bucket
+
+
+def test_export_buckets(drained_token_bucket: TokenBucketCarousel):
+    buckets = {
+        (model, region, tenant): state
+        for model, region, tenant, state in drained_token_bucket.export_buckets()
+    }
+    assert len(buckets) == 5
+    assert buckets[("MODEL-2", "uk", None)] == {
+        "token_allowance": 10,
+        "token_refresh_seconds": 1,
+        "meta": {"model": "MODEL-2", "region": "uk"},
+        "tokens_remaining": 8,
+        "last_refresh": 12345,
+    }
+    assert buckets[("MODEL-2", "uk", "acme")]["tokens_remaining"] == 1
+
+
+def test_import_buckets(token_bucket: TokenBucketCarousel):
+    count = token_bucket.import_buckets(
+        [
+            (
+                "MODEL-1",
+                "uk",
+                None,
+                {
+                    "token_allowance": 5,
+                    "token_refresh_seconds": 60,
+                    "meta": {"model": "MODEL-1", "region": "uk"},
+                    "tokens_remaining": 2,
+                    "last_refresh": 12345,
+                },
+            ),
+            (
+                "MODEL-1",
+                "uk",
+                "acme",
+                {
+                    "token_allowance": 3,
+                    "token_refresh_seconds": 60,
+                    "tokens_remaining": 0,
+                    "last_refresh": 12345,
+                },
+            ),
+        ]
+    )
+    assert count == 2
+    assert token_bucket.list_model_regions("MODEL-1") == {"uk"}
+    assert token_bucket.read_model_region("MODEL-1", "uk")["tokens_remaining"] == 2
+    assert (
+        token_bucket.read_tenant_quota("MODEL-1", "uk", "acme")["tokens_remaining"] == 0
+    )
+
+
+def test_snapshot_round_trip(drained_token_bucket: TokenBucketCarousel):
+    fp = io.BytesIO()
+    assert dump(drained_token_bucket.export_buckets(), fp) == 5
+    fp.seek(0)
+    assert sorted(load(fp), key=str) == sorted(
+        drained_token_bucket.export_buckets(), key=str
+    )
+
+
+def test_load_rejects_unknown_format():
+    with pytest.raises(ValueError, match="Not a token bucket carousel snapshot"):
+        list(load(io.BytesIO(b"nope")))
+
+
+def test_load_rejects_truncated_snapshot(drained_token_bucket: TokenBucketCarousel):
+    fp = io.BytesIO()
+    dump(drained_token_bucket.export_buckets(), fp)
+    with pytest.raises(ValueError, match="Truncated snapshot"):
+        list(load(io.BytesIO(fp.getvalue()[:-1])))
+
+
+def test_migrate_from_backend(drained_token_bucket: TokenBucketCarousel):
+    dst = InMemoryTokenBucketCarousel()
+    assert migrate(drained_token_bucket, dst, batch_size=2) == 5
+    assert sorted(dst.export_buckets(), key=str) == sorted(
+        drained_token_bucket.export_buckets(), key=str
+    )
+
+
+def test_migrate_to_backend(token_bucket: TokenBucketCarousel):
+    src = InMemoryTokenBucketCarousel()
+    for i in range(30):
+        src.create_model_region(f"MODEL-{i}", "uk", 1, 1, {"model": f"MODEL-{i}"})
+    assert migrate(src, token_bucket, batch_size=7) == 30
+    assert len(token_bucket.list_models()) == 30
@@ -0,0 +1,122 @@
+from unittest.mock import patch
+
+import pytest
+
+from tbc.abstract_token_bucket_carousel import TokenBucketCarousel
+from tbc.errors import (
+    InsufficientTokensError,
+    InvalidModelError,
+    InvalidRegionError,
+    InvalidTenantError,
+)
+
+
+@pytest.fixture(scope="function")
+def tenant_token_bucket(populated_token_bucket: TokenBucketCarousel):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        populated_token_bucket.create_tenant_quota("MODEL-2", "uk", "acme", 3, 1)
+    return populated_token_bucket
+
+
+def test_create_tenant_quota(tenant_token_bucket: TokenBucketCarousel):
+    quota = tenant_token_bucket.read_tenant_quota("MODEL-2", "uk", "acme")
+    assert quota == {
+        "token_allowance": 3,
+        "token_refresh_seconds": 1,
+        "tokens_remaining": 3,
+        "last_refresh": 12345,
+    }, "Tenant quota not created"
+
+
+def test_tenant_quota_not_listed_as_region(tenant_token_bucket: TokenBucketCarousel):
+    assert tenant_token_bucket.list_models() == {"MODEL-1", "MODEL-2"}
+    assert tenant_token_bucket.list_model_regions("MODEL-2") == {"uk", "us"}
+
+
+def test_create_tenant_quota_already_exists(tenant_token_bucket: TokenBucketCarousel):
+    with pytest.raises(
+        ValueError, match="Model MODEL-2 region uk already has tenant acme"
+    ):
+        tenant_token_bucket.create_tenant_quota("MODEL-2", "uk", "acme", 3, 1)
+
+
+def test_create_tenant_quota_region_does_not_exist(
+    tenant_token_bucket: TokenBucketCarousel,
+):
+    with pytest.raises(
+        InvalidRegionError, match="Model MODEL-2 does not have region fr"
+    ):
+        tenant_token_bucket.create_tenant_quota("MODEL-2", "fr", "acme", 3, 1)
+
+
+def test_delete_tenant_quota(tenant_token_bucket: TokenBucketCarousel):
+    tenant_token_bucket.delete_tenant_quota("MODEL-2", "uk", "acme")
+    with pytest.raises(
+        InvalidTenantError, match="Model MODEL-2 region uk does not have tenant acme"
+    ):
+        tenant_token_bucket.read_tenant_quota("MODEL-2", "uk", "acme")
+
+
+def test_delete_tenant_quota_does_not_exist(tenant_token_bucket: TokenBucketCarousel):
+    with pytest.raises(
+        InvalidTenantError, match="Model MODEL-2 region uk does not have tenant other"
+    ):
+        tenant_token_bucket.delete_tenant_quota("MODEL-2", "uk", "other")
+
+
+def test_delete_region_deletes_tenant_quotas(tenant_token_bucket: TokenBucketCarousel):
+    tenant_token_bucket.delete_model_region("MODEL-2", "uk")
+    tenant_token_bucket.delete_model_region("MODEL-2", "us")
+    assert tenant_token_bucket.list_models() == {"MODEL-1"}
+    with pytest.raises(InvalidModelError):
+        tenant_token_bucket.list_model_regions("MODEL-2")
+
+    tenant_token_bucket.create_model_region("MODEL-2", "uk", 10, 1, {})
+    with pytest.raises(InvalidTenantError):
+        tenant_token_bucket.read_tenant_quota("MODEL-2", "uk", "acme")
+
+
+async def test_request_tokens_decrements_tenant_and_region(
+    tenant_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(tenant_token_bucket, "_current_time", return_value=12345):
+        meta = await tenant_token_bucket.request_tokens("MODEL-2", 2, tenant="acme")
+    assert meta == {"model": "MODEL-2", "region": "uk"}
+    assert (
+        tenant_token_bucket.read_tenant_quota("MODEL-2", "uk", "acme")[
+            "tokens_remaining"
+        ]
+        == 1
+    )
+    assert (
+        tenant_token_bucket.read_model_region("MODEL-2", "uk")["tokens_remaining"] == 8
+    )
+
+
+async def test_request_tokens_tenant_exhausted_leaves_region_untouched(
+    tenant_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(tenant_token_bucket, "_current_time", return_value=12345):
+        with pytest.raises(InsufficientTokensError):
+            await tenant_token_bucket.request_tokens(
+                "MODEL-2", 4, allowed_regions={"uk"}, tenant="acme"
+            )
+    assert (
+        tenant_token_bucket.read_tenant_quota("MODEL-2", "uk", "acme")[
+            "tokens_remaining"
+        ]
+        == 3
+    )
+    assert (
+        tenant_token_bucket.read_model_region("MODEL-2", "uk")["tokens_remaining"] == 10
+    )
+
+
+@pytest.mark.parametrize(
+    "token_bucket",
+    ["dynamodb_token_bucket", "compact_redis_token_bucket"],
+    indirect=True,
+)
+def test_create_region_with_tenant_separator(token_bucket: TokenBucketCarousel):
+    with pytest.raises(ValueError, match="Region uk#acme must not contain '#'"):
+        token_bucket.create_model_region("MODEL-1", "uk#acme", 1, 1, {})
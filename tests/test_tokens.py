@@ -1,7 +1,9 @@
+from unittest.mock import patch
+
 import pytest
 
 from tbc.abstract_token_bucket_carousel import TokenBucketCarousel
-from tbc.errors import InvalidRegionError
+from tbc.errors import InsufficientTokensError, InvalidRegionError
 
 
 def test_replenish_tokens(populated_token_bucket: TokenBucketCarousel):
@@ -10,6 +12,17 @@ def test_replenish_tokens(populated_token_bucket: TokenBucketCarousel):
     assert region["tokens_remaining"] == region["token_allowance"]
 
 
+def test_replenish_tokens_refills_drained_region(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        populated_token_bucket._take_tokens("MODEL-1", "us", 5)
+    with patch.object(populated_token_bucket, "_current_time", return_value=12346):
+        populated_token_bucket.replenish_tokens("MODEL-1", "us")
+    region = populated_token_bucket.read_model_region("MODEL-1", "us")
+    assert region["tokens_remaining"] == 5
+
+
 def test_replenish_tokens_unknown_region(populated_token_bucket: TokenBucketCarousel):
     with pytest.raises(
         InvalidRegionError, match="Model MODEL-1 does not have region fr"
@@ -21,3 +34,124 @@ async def test_request_1_token(populated_token_bucket: TokenBucketCarousel):
     meta = await populated_token_bucket.request_tokens("MODEL-1", 1)
     region = populated_token_bucket.read_model_region(meta["model"], meta["region"])
     assert region["tokens_remaining"] == region["token_allowance"] - 1
+
+
+async def test_request_tokens_rotates_exhausted_region(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        first = await populated_token_bucket.request_tokens(
+            "MODEL-1", 1, preferred_region="uk"
+        )
+        second = await populated_token_bucket.request_tokens(
+            "MODEL-1", 1, preferred_region="uk"
+        )
+    assert first["region"] == "uk"
+    assert second["region"] == "us"
+
+
+async def test_request_tokens_fallback_model(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        meta = await populated_token_bucket.request_tokens(
+            "MODEL-1", 10, fallback_models={"MODEL-2"}
+        )
+    assert meta["model"] == "MODEL-2"
+
+
+async def test_request_tokens_insufficient(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        with pytest.raises(InsufficientTokensError):
+            await populated_token_bucket.request_tokens("MODEL-1", 6)
+
+
+async def test_request_tokens_refreshes_elapsed_bucket(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        await populated_token_bucket.request_tokens(
+            "MODEL-1", 1, allowed_regions={"uk"}
+        )
+    with patch.object(populated_token_bucket, "_current_time", return_value=12346):
+        meta = await populated_token_bucket.request_tokens(
+            "MODEL-1", 1, allowed_regions={"uk"}
+        )
+    region = populated_token_bucket.read_model_region("MODEL-1", "uk")
+    assert meta["region"] == "uk"
+    assert region["tokens_remaining"] == 0
+    assert region["last_refresh"] == 12346
+
+
+async def test_request_tokens_insufficient_retry_after(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        await populated_token_bucket.request_tokens("MODEL-1", 5)
+        with pytest.raises(InsufficientTokensError) as exc_info:
+            await populated_token_bucket.request_tokens("MODEL-1", 2)
+    assert exc_info.value.retry_after == 1
+
+
+async def test_request_tokens_above_allowance_retry_after(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    with pytest.raises(InsufficientTokensError) as exc_info:
+        await populated_token_bucket.request_tokens("MODEL-1", 6)
+    assert exc_info.value.retry_after is None
+
+
+def test_consume_tokens(populated_token_bucket: TokenBucketCarousel):
+    populated_token_bucket.create_tenant_quota("MODEL-2", "uk", "acme", 3, 1)
+    with patch.object(populated_token_bucket, "_current_time", return_value=12345):
+        states = populated_token_bucket.consume_tokens(
+            {
+                ("MODEL-2", "uk", None): 4,
+                ("MODEL-2", "us", None): 25,
+                ("MODEL-2", "uk", "acme"): 0,
+                ("MODEL-2", "fr", None): 1,
+            }
+        )
+    assert states[("MODEL-2", "uk", None)]["tokens_remaining"] == 6
+    assert states[("MODEL-2", "us", None)]["tokens_remaining"] == 0
+    assert states[("MODEL-2", "uk", "acme")]["token_allowance"] == 3
+    assert ("MODEL-2", "fr", None) not in states
+    region = populated_token_bucket.read_model_region("MODEL-2", "uk")
+    assert region["tokens_remaining"] == 6
+
+
+async def test_request_tokens_forgets_region_deleted_elsewhere(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    await populated_token_bucket.request_tokens("MODEL-2", 1, preferred_region="uk")
+    # As another client would, without invalidating this one's cached regions
+    with patch.object(populated_token_bucket, "_forget_regions"):
+        populated_token_bucket.delete_model_region("MODEL-2", "uk")
+
+    meta = await populated_token_bucket.request_tokens(
+        "MODEL-2", 1, preferred_region="uk"
+    )
+    assert meta["region"] == "us"
+    assert populated_token_bucket._get_regions("MODEL-2") == {"us"}
+
+
+async def test_request_tokens_relists_regions_after_cache_expiry(
+    populated_token_bucket: TokenBucketCarousel,
+):
+    await populated_token_bucket.request_tokens("MODEL-2", 1)
+    with patch.object(populated_token_bucket, "_forget_regions"):
+        populated_token_bucket.create_model_region(
+            "MODEL-2", "fr", 10, 1, {"model": "MODEL-2", "region": "fr"}
+        )
+    with pytest.raises(InsufficientTokensError):
+        await populated_token_bucket.request_tokens(
+            "MODEL-2", 1, allowed_regions={"fr"}
+        )
+
+    populated_token_bucket.region_cache_seconds = 0
+    meta = await populated_token_bucket.request_tokens(
+        "MODEL-2", 1, allowed_regions={"fr"}
+    )
+    assert meta["region"] == "fr"